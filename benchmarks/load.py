@@ -0,0 +1,309 @@
+"""
+Load test of every API route with a mix of concurrent reads and writes.
+
+It seeds a throwaway database (see seed.py), then drives the routes from several
+threads, either through the in-process WSGI test client or against a real gunicorn,
+and writes throughput and p50/p95/p99 latency per route to a JSON file. Give it the
+JSON of a previous run with --compare to see the difference.
+
+    $ pipenv run python benchmarks/load.py --target inprocess --output before.json
+    $ pipenv run python benchmarks/load.py --target gunicorn --workers 4 --output after.json --compare before.json
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from seed import SRC, DEFAULT_VOLUMES, add_volume_arguments, create_bench_app, seed
+
+class Scenario:
+    # every route is (name, kind, build) and build(rng) returns (method, path, json body)
+
+    # the last rows of each seeded table are only for the DELETE routes, the other routes
+    # never pick them, so deleting does not turn their requests into 404s
+    DELETABLE_FRACTION = 0.2
+
+    def __init__(self, volumes):
+        self.volumes = volumes
+        self.counter = itertools.count()
+        self.deleted = {name: itertools.count(self.kept(name) + 1) for name in ("people", "planets", "vehicles")}
+
+    def kept(self, name):
+        volume = self.volumes[name]
+        if name not in ("people", "planets", "vehicles"):
+            return volume
+        return volume - int(volume * self.DELETABLE_FRACTION)
+
+    def some(self, name, rng):
+        return rng.randint(1, max(self.kept(name), 1))
+
+    def deletable(self, name):
+        # once every reserved row is gone the DELETE routes answer 404
+        return next(self.deleted[name])
+
+    def unique(self):
+        return next(self.counter)
+
+    def routes(self):
+        from utils import encode_cursor
+
+        def planet_body(name):
+            return {"name": name, "gravity": "1", "population": "1000", "terrain": "desert"}
+
+        def person_body(name):
+            return {"name": name, "gender": "n/a", "birth_year": "19BBY", "mass": "77"}
+
+        def vehicle_body(name):
+            return {"name": name, "model": "T-16 skyhopper", "manufacturer": "Incom Corporation", "cost_in_credits": "14500"}
+
+        return [
+            ("GET /", "read", lambda rng: ("GET", "/", None)),
+            ("GET /cache/stats", "read", lambda rng: ("GET", "/cache/stats", None)),
+            ("GET /compression/stats", "read", lambda rng: ("GET", "/compression/stats", None)),
+            ("GET /pool/stats", "read", lambda rng: ("GET", "/pool/stats", None)),
+            ("GET /people", "read", lambda rng: ("GET", "/people?limit=100", None)),
+            ("GET /people?after", "read", lambda rng: ("GET", "/people?limit=100&after=%s" % encode_cursor(self.some("people", rng)), None)),
+            ("GET /people/<id>", "read", lambda rng: ("GET", "/people/%d" % self.some("people", rng), None)),
+            ("GET /planets", "read", lambda rng: ("GET", "/planets?limit=100", None)),
+            ("GET /planets/<id>", "read", lambda rng: ("GET", "/planets/%d" % self.some("planets", rng), None)),
+            ("GET /vehicles", "read", lambda rng: ("GET", "/vehicles?limit=100", None)),
+            ("GET /search", "read", lambda rng: ("GET", "/search?q=%s" % rng.choice(("Planet", "Person 1", "Vehicle 2", "desert")), None)),
+            ("GET /leaderboard", "read", lambda rng: ("GET", "/leaderboard?type=%s" % rng.choice(("planet", "people", "vehicle")), None)),
+            ("GET /users", "read", lambda rng: ("GET", "/users?limit=50", None)),
+            ("GET /users?include", "read", lambda rng: ("GET", "/users?limit=50&include=favorites.planet,favorites.people,favorites.vehicle", None)),
+            ("GET /users/favorites", "read", lambda rng: ("GET", "/users/favorites", None)),
+            ("GET /users/<id>/favorites", "read", lambda rng: ("GET", "/users/%d/favorites" % self.some("users", rng), None)),
+            ("POST /planet", "write", lambda rng: ("POST", "/planet", planet_body("Bench planet %d" % self.unique()))),
+            ("PUT /planet/<id>", "write", lambda rng: self.edit(rng, "planets", "/planet/%d", planet_body, "Planet %d")),
+            ("DELETE /planet/<id>", "write", lambda rng: ("DELETE", "/planet/%d" % self.deletable("planets"), None)),
+            ("POST /planet/bulk", "write", lambda rng: ("POST", "/planet/bulk", [planet_body("Bench bulk %d" % self.unique()) for _ in range(20)])),
+            ("POST /people", "write", lambda rng: ("POST", "/people/", person_body("Bench person %d" % self.unique()))),
+            ("PUT /people/<id>", "write", lambda rng: self.edit(rng, "people", "/people/%d", person_body, "Person %d")),
+            ("DELETE /people/<id>", "write", lambda rng: ("DELETE", "/people/%d" % self.deletable("people"), None)),
+            ("POST /people/bulk", "write", lambda rng: ("POST", "/people/bulk", [person_body("Bench bulk %d" % self.unique()) for _ in range(20)])),
+            ("POST /vehicle", "write", lambda rng: ("POST", "/vehicle", vehicle_body("Bench vehicle %d" % self.unique()))),
+            ("PUT /vehicles/<id>", "write", lambda rng: self.edit(rng, "vehicles", "/vehicles/%d", vehicle_body, "Vehicle %d")),
+            ("DELETE /vehicles/<id>", "write", lambda rng: ("DELETE", "/vehicles/%d" % self.deletable("vehicles"), None)),
+            ("POST /vehicle/bulk", "write", lambda rng: ("POST", "/vehicle/bulk", [vehicle_body("Bench bulk %d" % self.unique()) for _ in range(20)])),
+            ("POST /favorite/planet/<id>", "write", lambda rng: ("POST", "/favorite/planet/%d" % self.some("planets", rng), {"user_id": self.some("users", rng)})),
+            ("DELETE /favorite/planet/<id>", "write", lambda rng: ("DELETE", "/favorite/planet/%d" % self.some("planets", rng), {"user_id": self.some("users", rng)})),
+            ("POST /favorite/people/<id>", "write", lambda rng: ("POST", "/favorite/people/%d" % self.some("people", rng), {"user_id": self.some("users", rng)})),
+            ("DELETE /favorite/people/<id>", "write", lambda rng: ("DELETE", "/favorite/people/%d" % self.some("people", rng), {"user_id": self.some("users", rng)})),
+            ("POST /favorite/batch", "write", lambda rng: ("POST", "/favorite/batch", {
+                "user_id": self.some("users", rng),
+                "add": {"people": [self.some("people", rng) for _ in range(5)]},
+                "remove": {"vehicles": [self.some("vehicles", rng) for _ in range(5)]},
+            })),
+        ]
+
+    def edit(self, rng, name, path, body, seeded_name):
+        item_id = self.some(name, rng)
+        # seeded rows are called "<Type> <id - 1>", keeping the name keeps it unique
+        values = body(seeded_name % (item_id - 1))
+        if name == "planets":
+            values.update(gravity=rng.choice(("1", "2")), population=str(rng.randint(0, 10 ** 9)))
+        return ("PUT", path % item_id, values)
+
+def missing_routes(app, routes):
+    # endpoints of the API that no route of the scenario reaches, checked against url_map
+    # so a new route shows up here until it is added above
+    adapter = app.url_map.bind("localhost")
+    reached = set()
+    rng = random.Random(0)
+    for _, _, build in routes:
+        method, path, _ = build(rng)
+        reached.add(adapter.match(path.split("?")[0], method=method)[0])
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith("api.")}
+    return sorted(endpoints - reached)
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body):
+        response = self.client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+class HTTPClient:
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, body):
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        self.connection.request(method, path, body=payload, headers=headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_gunicorn(database_url, workers, port, env):
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", SRC, "--preload",
+         "--workers", str(workers), "--bind", "127.0.0.1:%d" % port],
+        env=dict(os.environ, DATABASE_URL=database_url, ENABLE_ADMIN="0", **env),
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("gunicorn did not start on port %d" % port)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(samples),
+        "errors": sum(count for status, count in statuses.items() if status == "error" or status.startswith("5")),
+        "statuses": statuses,
+        "rps": round(len(samples) / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+def run(make_client, routes, concurrency, duration, write_ratio, seed_value):
+    reads = [route for route in routes if route[1] == "read"]
+    writes = [route for route in routes if route[1] == "write"]
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(number):
+        rng = random.Random(seed_value * 1000 + number)
+        client = make_client()
+        samples = []
+        while time.perf_counter() < deadline:
+            name, _, build = rng.choice(writes if writes and rng.random() < write_ratio else reads)
+            method, path, body = build(rng)
+            started = time.perf_counter()
+            try:
+                status = client.request(method, path, body)
+            except Exception:
+                status = "error"
+            samples.append((name, time.perf_counter() - started, status))
+        with lock:
+            results.extend(samples)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    by_route = {}
+    for name, latency, status in results:
+        by_route.setdefault(name, []).append((latency, status))
+    return {
+        "routes": {name: summarize(samples, elapsed) for name, samples in sorted(by_route.items())},
+        "total": summarize([(latency, status) for _, latency, status in results], elapsed),
+    }
+
+def compare(previous, current):
+    print("\n%-32s %12s %12s %12s %12s" % ("route", "rps before", "rps after", "p95 before", "p95 after"))
+    for name in sorted(set(previous["routes"]) | set(current["routes"])):
+        before = previous["routes"].get(name, {})
+        after = current["routes"].get(name, {})
+        print("%-32s %12s %12s %12s %12s" % (name, before.get("rps"), after.get("rps"), before.get("p95_ms"), after.get("p95_ms")))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", help="SQLAlchemy URL of a throwaway database (default: a temporary SQLite file)")
+    parser.add_argument("--target", choices=("inprocess", "gunicorn"), default="inprocess")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--compare", help="JSON file of a previous run")
+    add_volume_arguments(parser)
+    options = parser.parse_args()
+
+    database = options.database or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    volumes = {name: getattr(options, name) for name in DEFAULT_VOLUMES}
+    config = {"CACHE_ENABLED": not options.no_cache}
+
+    from models import db
+    app = create_bench_app(database, **config)
+    with app.app_context():
+        seed(db, seed_value=options.seed, **volumes)
+        db.session.remove()
+
+    routes = Scenario(volumes).routes()
+    missing = missing_routes(app, Scenario(volumes).routes())
+    if missing:
+        raise SystemExit("the scenario does not reach these routes: " + ", ".join(missing))
+
+    process = None
+    if options.target == "gunicorn":
+        port = free_port()
+        process = start_gunicorn(database, options.workers, port, {"CACHE_ENABLED": "0" if options.no_cache else "1"})
+        make_client = lambda: HTTPClient("127.0.0.1", port)
+    else:
+        make_client = lambda: InProcessClient(app)
+
+    try:
+        report = run(make_client, routes, options.concurrency, options.duration, options.write_ratio, options.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report["meta"] = {
+        "target": options.target,
+        "workers": options.workers if options.target == "gunicorn" else None,
+        "concurrency": options.concurrency,
+        "duration": options.duration,
+        "write_ratio": options.write_ratio,
+        "cache": not options.no_cache,
+        "database": database.split("://")[0],
+        "volumes": volumes,
+        "python": platform.python_version(),
+        "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(options.output, "w") as output:
+        json.dump(report, output, indent=2, sort_keys=True)
+
+    print("%-32s %10s %8s %10s %10s %10s" % ("route", "requests", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for name, stats in report["routes"].items():
+        print("%-32s %10d %8d %10s %10s %10s" % (name, stats["requests"], stats["errors"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+    print("total: %(requests)d requests, %(rps)s req/s, p95 %(p95_ms)s ms" % report["total"])
+
+    if options.compare:
+        with open(options.compare) as previous:
+            compare(json.load(previous), report)
+
+if __name__ == "__main__":
+    main()
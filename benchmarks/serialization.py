@@ -0,0 +1,82 @@
+"""
+Compares the two read paths of the list endpoints:
+
+- orm: Model.query ... .all() + serialize() for every instance (the old path)
+- core: keyset_rows(), a Core SELECT of the serialized columns turned into dicts
+
+For every size it reports rows/sec and the peak Python memory (tracemalloc) of
+building the JSON body, and checks that both bodies are byte for byte the same.
+
+    $ pipenv run python benchmarks/serialization.py --sizes 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+def seed(db, Planets, size):
+    from sqlalchemy import insert
+    db.session.execute(Planets.__table__.delete())
+    rows = [
+        {"name": "planet-%d" % i, "gravity": "1", "population": str(i), "terrain": "desert"}
+        for i in range(size)
+    ]
+    for start in range(0, size, 10000):
+        db.session.execute(insert(Planets), rows[start:start + 10000])
+    db.session.commit()
+
+def orm_body(app, db, Planets, size):
+    planets = Planets.query.order_by(Planets.id).limit(size).all()
+    return app.json.dumps([planet.serialize() for planet in planets])
+
+def core_body(app, db, Planets, size):
+    from utils import keyset_rows
+    items, _ = keyset_rows(db.session, Planets, None, size)
+    return app.json.dumps(items)
+
+def measure(function, *args):
+    start = time.perf_counter()
+    body = function(*args)
+    elapsed = time.perf_counter() - start
+    args[1].session.remove()
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    args[1].session.remove()
+    return body, elapsed, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    options = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["DATABASE_URL"] = "sqlite:///" + database
+    os.environ["CACHE_ENABLED"] = "0"
+
+    from app import create_app
+    from models import db, Planets
+
+    app = create_app()
+
+    with app.test_request_context():
+        db.create_all()
+        print("%10s %6s %14s %14s" % ("rows", "path", "rows/sec", "peak MiB"))
+        for size in options.sizes:
+            seed(db, Planets, size)
+            bodies = {}
+            for name, function in (("orm", orm_body), ("core", core_body)):
+                body, elapsed, peak = measure(function, app, db, Planets, size)
+                bodies[name] = body
+                print("%10d %6s %14.0f %14.1f" % (size, name, size / elapsed, peak / 1024 / 1024))
+            if bodies["orm"] != bodies["core"]:
+                raise SystemExit("the two paths produced different bodies for %d rows" % size)
+
+if __name__ == "__main__":
+    main()
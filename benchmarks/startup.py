@@ -0,0 +1,133 @@
+"""
+Measures how long a worker takes to import the app and build it with create_app(), with
+and without Flask-Admin, and the memory of the gunicorn workers with and without --preload.
+
+The startup samples run in a fresh interpreter each, so nothing is already imported.
+
+The memory of a forked worker is mostly pages shared with the master, so its RSS says
+little; the table reports, per worker, the PSS (shared pages split between the processes
+that map them) and the USS (pages only that worker has), read from
+/proc/<pid>/smaps_rollup after a few requests. With --preload the app is built once in
+the master and the workers share it copy-on-write: the USS per worker is what each extra
+worker costs. Linux only.
+
+    $ pipenv run python benchmarks/startup.py --runs 5 --workers 4
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app()
+built = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "startup_seconds": built - start,
+}))
+"""
+
+def sample(enable_admin):
+    env = dict(os.environ, ENABLE_ADMIN="1" if enable_admin else "0")
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=SRC, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def children(pid):
+    with open("/proc/%d/task/%d/children" % (pid, pid)) as handle:
+        return [int(child) for child in handle.read().split()]
+
+def memory_kib(pid):
+    values = {}
+    with open("/proc/%d/smaps_rollup" % pid) as handle:
+        for line in handle:
+            name, _, rest = line.partition(":")
+            if rest.strip().endswith("kB"):
+                values[name] = int(rest.split()[0])
+    return {"pss": values["Pss"], "uss": values["Private_Clean"] + values["Private_Dirty"]}
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("gunicorn did not answer on port %d" % port)
+
+def worker_memory(preload, enable_admin, workers, warmup):
+    port = free_port()
+    env = dict(os.environ, ENABLE_ADMIN="1" if enable_admin else "0")
+    command = [sys.executable, "-m", "gunicorn", "wsgi", "--chdir", SRC, "--workers", str(workers),
+               "--bind", "127.0.0.1:%d" % port, "--log-level", "warning"]
+    if preload:
+        command.append("--preload")
+    master = subprocess.Popen(command, env=env)
+    try:
+        wait_for(port)
+        deadline = time.monotonic() + 30
+        while len(children(master.pid)) < workers and time.monotonic() < deadline:
+            time.sleep(0.1)
+        # every worker serves some requests, touching (and copying) what a real one would
+        for _ in range(warmup * workers):
+            urllib.request.urlopen("http://127.0.0.1:%d/metrics" % port).read()
+        pids = children(master.pid)
+        samples = [memory_kib(pid) for pid in pids]
+        master_memory = memory_kib(master.pid)
+    finally:
+        master.terminate()
+        master.wait()
+
+    return {
+        "workers": len(samples),
+        "pss_per_worker_mib": statistics.median(item["pss"] for item in samples) / 1024,
+        "uss_per_worker_mib": statistics.median(item["uss"] for item in samples) / 1024,
+        "pss_total_mib": (master_memory["pss"] + sum(item["pss"] for item in samples)) / 1024,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=20, help="requests per worker before measuring")
+    options = parser.parse_args()
+
+    print("%-8s %16s %16s" % ("admin", "import (ms)", "startup (ms)"))
+    for enable_admin in (True, False):
+        samples = [sample(enable_admin) for _ in range(options.runs)]
+        print("%-8s %16.1f %16.1f" % (
+            "on" if enable_admin else "off",
+            statistics.median(item["import_seconds"] for item in samples) * 1000,
+            statistics.median(item["startup_seconds"] for item in samples) * 1000,
+        ))
+
+    print()
+    print("%-8s %-9s %8s %18s %18s %16s" % ("admin", "preload", "workers", "PSS/worker MiB", "USS/worker MiB", "PSS total MiB"))
+    for enable_admin in (True, False):
+        for preload in (True, False):
+            result = worker_memory(preload, enable_admin, options.workers, options.warmup)
+            print("%-8s %-9s %8d %18.1f %18.1f %16.1f" % (
+                "on" if enable_admin else "off", "yes" if preload else "no", result["workers"],
+                result["pss_per_worker_mib"], result["uss_per_worker_mib"], result["pss_total_mib"],
+            ))
+
+if __name__ == "__main__":
+    main()
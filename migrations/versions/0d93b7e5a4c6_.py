@@ -0,0 +1,51 @@
+"""favorite_count counters on planets, people and vehicles
+
+Revision ID: 0d93b7e5a4c6
+Revises: f6a2c8e4b190
+Create Date: 2026-10-18 20:37:12.548330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0d93b7e5a4c6'
+down_revision = 'f6a2c8e4b190'
+branch_labels = None
+depends_on = None
+
+# table: column of favorite that points to it
+COUNTED_TABLES = {'planets': 'planet_id', 'people': 'people_id', 'vehicles': 'vehicle_id'}
+
+
+def upgrade():
+    connection = op.get_bind()
+    favorite = sa.table('favorite', *[sa.column(column) for column in COUNTED_TABLES.values()])
+
+    for table_name, column in COUNTED_TABLES.items():
+        op.add_column(table_name, sa.Column('favorite_count', sa.Integer(), nullable=False, server_default='0'))
+
+        target = favorite.c[column]
+        counts = connection.execute(
+            sa.select(target, sa.func.count()).where(target.isnot(None)).group_by(target)
+        ).all()
+        if counts:
+            table = sa.table(table_name, sa.column('id'), sa.column('favorite_count'))
+            connection.execute(
+                sa.update(table).where(table.c.id == sa.bindparam('_id')).values(favorite_count=sa.bindparam('_count')),
+                [{'_id': item_id, '_count': count} for item_id, count in counts]
+            )
+
+        op.create_index('ix_%s_favorite_count' % table_name, table_name, ['favorite_count', 'id'], unique=False)
+
+
+def downgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table_name in COUNTED_TABLES:
+        op.drop_index('ix_%s_favorite_count' % table_name, table_name=table_name)
+        if sqlite:
+            # a batch copy of the table would also drop its search triggers
+            op.execute('ALTER TABLE %s DROP COLUMN favorite_count' % table_name)
+        else:
+            op.drop_column(table_name, 'favorite_count')
@@ -0,0 +1,38 @@
+"""favorite composite indexes
+
+Revision ID: 3f9c2d1b7a64
+Revises: dfa754f5ee27
+Create Date: 2026-10-18 10:12:41.402218
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2d1b7a64'
+down_revision = 'dfa754f5ee27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # remove duplicated favorites (keep the oldest one) so the unique indexes can be built
+    for column in ('planet_id', 'people_id', 'vehicle_id'):
+        op.execute(
+            "DELETE FROM favorite WHERE {col} IS NOT NULL AND id NOT IN ("
+            "SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM favorite "
+            "WHERE {col} IS NOT NULL GROUP BY user_id, {col}) AS keep)".format(col=column)
+        )
+
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.create_index('ix_favorite_user_planet', ['user_id', 'planet_id'], unique=True)
+        batch_op.create_index('ix_favorite_user_people', ['user_id', 'people_id'], unique=True)
+        batch_op.create_index('ix_favorite_user_vehicle', ['user_id', 'vehicle_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('favorite', schema=None) as batch_op:
+        batch_op.drop_index('ix_favorite_user_vehicle')
+        batch_op.drop_index('ix_favorite_user_people')
+        batch_op.drop_index('ix_favorite_user_planet')
@@ -0,0 +1,31 @@
+"""table version counters
+
+Revision ID: 8b41e6f0c2d9
+Revises: 3f9c2d1b7a64
+Create Date: 2026-10-18 11:03:27.915340
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b41e6f0c2d9'
+down_revision = '3f9c2d1b7a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': name, 'version': 0} for name in ('user', 'planets', 'people', 'vehicles', 'favorite')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
@@ -0,0 +1,80 @@
+"""search index on the names of people, planets and vehicles
+
+Revision ID: c4e7a9d2f813
+Revises: 8b41e6f0c2d9
+Create Date: 2026-10-18 15:42:08.120554
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e7a9d2f813'
+down_revision = '8b41e6f0c2d9'
+branch_labels = None
+depends_on = None
+
+# table: (type code of the sqlite rowid, indexed columns besides name)
+SEARCH_TABLES = {
+    'people': (1, ()),
+    'planets': (2, ('terrain',)),
+    'vehicles': (3, ('manufacturer', 'model')),
+}
+
+POSTGRES_DOCUMENTS = {
+    'people': "setweight(to_tsvector('simple', name), 'A')",
+    'planets': "setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', coalesce(terrain, '')), 'B')",
+    'vehicles': "setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', coalesce(manufacturer, '') || ' ' || coalesce(model, '')), 'B')",
+}
+
+
+def sqlite_detail(prefix, columns):
+    if not columns:
+        return "''"
+    return " || ' ' || ".join("coalesce(%s.%s, '')" % (prefix, column) for column in columns)
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        for table, document in POSTGRES_DOCUMENTS.items():
+            op.execute('CREATE INDEX ix_%s_search ON %s USING gin ((%s))' % (table, table, document))
+        return
+
+    if dialect != 'sqlite':
+        return
+
+    op.execute(
+        "CREATE VIRTUAL TABLE search_index USING fts5("
+        "name, detail, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    for table, (code, columns) in SEARCH_TABLES.items():
+        insert_new = "INSERT INTO search_index (rowid, name, detail) VALUES (new.id * 4 + %d, new.name, %s);" % (code, sqlite_detail('new', columns))
+        delete_old = "DELETE FROM search_index WHERE rowid = old.id * 4 + %d;" % code
+        op.execute('CREATE TRIGGER %s_search_insert AFTER INSERT ON %s BEGIN %s END' % (table, table, insert_new))
+        # only the indexed columns: favorite_count and the numeric copies change much more often
+        op.execute('CREATE TRIGGER %s_search_update AFTER UPDATE OF %s ON %s BEGIN %s %s END'
+                   % (table, ', '.join(('name',) + columns), table, delete_old, insert_new))
+        op.execute('CREATE TRIGGER %s_search_delete AFTER DELETE ON %s BEGIN %s END' % (table, table, delete_old))
+        op.execute(
+            'INSERT INTO search_index (rowid, name, detail) SELECT id * 4 + %d, name, %s FROM %s'
+            % (code, sqlite_detail(table, columns), table)
+        )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        for table in POSTGRES_DOCUMENTS:
+            op.execute('DROP INDEX ix_%s_search' % table)
+        return
+
+    if dialect != 'sqlite':
+        return
+
+    for table in SEARCH_TABLES:
+        for action in ('insert', 'update', 'delete'):
+            op.execute('DROP TRIGGER %s_search_%s' % (table, action))
+    op.execute('DROP TABLE search_index')
@@ -0,0 +1,82 @@
+"""numeric copies of population, gravity, mass and cost_in_credits
+
+Revision ID: e1b5f3a8c027
+Revises: c4e7a9d2f813
+Create Date: 2026-10-18 17:25:51.604318
+
+"""
+import math
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b5f3a8c027'
+down_revision = 'c4e7a9d2f813'
+branch_labels = None
+depends_on = None
+
+NUMERIC_COLUMNS = {
+    'planets': {'gravity': 'gravity_num', 'population': 'population_num'},
+    'people': {'mass': 'mass_num'},
+    'vehicles': {'cost_in_credits': 'cost_in_credits_num'},
+}
+
+NUMBER = re.compile(r"[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?")
+
+BATCH_SIZE = 1000
+
+
+def parse_number(value):
+    # same rules as models.parse_number at the time of this revision
+    if value is None:
+        return None
+    match = NUMBER.match(str(value).strip().lower().replace(",", ""))
+    if match is None:
+        return None
+    number = float(match.group())
+    return number if math.isfinite(number) else None
+
+
+def upgrade():
+    for table, columns in NUMERIC_COLUMNS.items():
+        for shadow in columns.values():
+            op.add_column(table, sa.Column(shadow, sa.Float(), nullable=True))
+
+    connection = op.get_bind()
+    for table_name, columns in NUMERIC_COLUMNS.items():
+        table = sa.table(table_name, sa.column('id'), *[sa.column(name) for name in list(columns) + list(columns.values())])
+        stmt = sa.update(table).where(table.c.id == sa.bindparam('_id')).values(
+            {shadow: sa.bindparam(shadow) for shadow in columns.values()}
+        )
+        last_id = 0
+        while True:
+            rows = connection.execute(
+                sa.select(table.c.id, *[table.c[name] for name in columns])
+                .where(table.c.id > last_id).order_by(table.c.id).limit(BATCH_SIZE)
+            ).all()
+            if not rows:
+                break
+            connection.execute(stmt, [
+                dict({'_id': row.id}, **{shadow: parse_number(row._mapping[field]) for field, shadow in columns.items()})
+                for row in rows
+            ])
+            last_id = rows[-1].id
+
+    for table, columns in NUMERIC_COLUMNS.items():
+        for shadow in columns.values():
+            # with the id: a sorted keyset page walks the index without sorting
+            op.create_index(op.f('ix_%s_%s' % (table, shadow)), table, [shadow, 'id'], unique=False)
+
+
+def downgrade():
+    sqlite = op.get_bind().dialect.name == 'sqlite'
+    for table, columns in NUMERIC_COLUMNS.items():
+        for shadow in columns.values():
+            op.drop_index(op.f('ix_%s_%s' % (table, shadow)), table_name=table)
+            if sqlite:
+                # a batch copy of the table would also drop its search triggers
+                op.execute('ALTER TABLE %s DROP COLUMN %s' % (table, shadow))
+            else:
+                op.drop_column(table, shadow)
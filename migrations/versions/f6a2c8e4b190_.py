@@ -0,0 +1,35 @@
+"""indexes for the filters of the list endpoints
+
+Revision ID: f6a2c8e4b190
+Revises: e1b5f3a8c027
+Create Date: 2026-10-18 19:08:44.271903
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f6a2c8e4b190'
+down_revision = 'e1b5f3a8c027'
+branch_labels = None
+depends_on = None
+
+# (index, table, columns): the id after the filtered column serves the keyset pagination
+FILTER_INDEXES = (
+    ('ix_people_gender', 'people', ['gender', 'id']),
+    ('ix_planets_terrain', 'planets', ['terrain', 'id']),
+    ('ix_planets_id_people', 'planets', ['id_people', 'id']),
+    ('ix_vehicles_manufacturer', 'vehicles', ['manufacturer', 'id']),
+    ('ix_vehicles_model', 'vehicles', ['model', 'id']),
+    ('ix_vehicles_people_id', 'vehicles', ['people_id', 'id']),
+)
+
+
+def upgrade():
+    for name, table, columns in FILTER_INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in FILTER_INDEXES:
+        op.drop_index(name, table_name=table)
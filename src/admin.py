@@ -3,6 +3,13 @@ from flask_admin import Admin
 from models import db, User, Planets, People, Vehicles, Favorite
 from flask_admin.contrib.sqla import ModelView
 
+class CatalogView(ModelView):
+    # the *_num columns are parsed from their text column and favorite_count is kept by
+    # the favorite endpoints, they are not edited by hand
+    def __init__(self, model, session, **kwargs):
+        self.form_excluded_columns = list(model.NUMERIC_FIELDS.values()) + ["favorite_count"]
+        super().__init__(model, session, **kwargs)
+
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
@@ -11,9 +18,9 @@ def setup_admin(app):
     
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(ModelView(User, db.session))
-    admin.add_view(ModelView(Planets, db.session))
-    admin.add_view(ModelView(People, db.session))
-    admin.add_view(ModelView(Vehicles, db.session))
+    admin.add_view(CatalogView(Planets, db.session))
+    admin.add_view(CatalogView(People, db.session))
+    admin.add_view(CatalogView(Vehicles, db.session))
     admin.add_view(ModelView(Favorite, db.session))
     # You can duplicate that line to add mew models
     # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
@@ -0,0 +1,9 @@
+# Serves only Flask-Admin, so the API workers (wsgi.py with ENABLE_ADMIN=0) never load it:
+# $ gunicorn admin_wsgi --chdir ./src/
+
+from app import create_app
+
+application = create_app({"ENABLE_API": False, "ENABLE_ADMIN": True})
+
+if __name__ == "__main__":
+    application.run()
@@ -2,138 +2,286 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
-from flask import Flask, request, jsonify, url_for
+from flask import Flask, Blueprint, request, jsonify, url_for, current_app
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Planets, People, Vehicles, Favorite
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from utils import APIException, generate_sitemap, encode_cursor, get_page_params, get_filter_params, get_include_params, get_fields_params, keyset_page, paginated_response, chunked, wants_stream, ndjson_response, stream_after, keyset_rows, stream_rows
+from cache import cache
+from etag import conditional
+from metrics import metrics
+from query_budget import budget, query_budget
+from compression import compressor
+from replicas import replicas, replica_urls
+from database import engine_options_from_env, configure_sqlite, pool_stats, env_flag, supports_update_returning, supports_delete_returning
+from models import db, User, Planets, People, Vehicles, Favorite, FAVORITE_KINDS, bump_versions, fields_options, numeric_values, change_favorite_counts
+from commands import import_command, export_command, rebuild_favorite_counts_command
+from search import search, search_terms, SEARCH_TYPES
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+api = Blueprint('api', __name__)
+MIGRATE = Migrate()
+
+def create_app(config=None):
+    # nothing here opens a database connection, so the app can be built once in the
+    # gunicorn master (--preload) and shared copy-on-write by every worker
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_REPLICA_URIS'] = replica_urls(os.getenv("DATABASE_REPLICA_URL"))
+    app.config['REPLICA_RETRY_SECONDS'] = float(os.getenv("DB_REPLICA_RETRY_SECONDS", 30))
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['API_PAGE_SIZE'] = int(os.getenv("API_PAGE_SIZE", 100))
+    app.config['API_MAX_PAGE_SIZE'] = int(os.getenv("API_MAX_PAGE_SIZE", 1000))
+    app.config['BULK_MAX_ITEMS'] = int(os.getenv("BULK_MAX_ITEMS", 5000))
+    app.config['CACHE_ENABLED'] = env_flag("CACHE_ENABLED", "1")
+    app.config['CACHE_TTL'] = int(os.getenv("CACHE_TTL", 60))
+    app.config['CACHE_MAX_ENTRIES'] = int(os.getenv("CACHE_MAX_ENTRIES", 1024))
+    app.config['METRICS_ENABLED'] = env_flag("METRICS_ENABLED", "1")
+    app.config['COMPRESS_ENABLED'] = env_flag("COMPRESS_ENABLED", "1")
+    app.config['COMPRESS_MIN_SIZE'] = int(os.getenv("COMPRESS_MIN_SIZE", 500))
+    app.config['COMPRESS_LEVEL'] = int(os.getenv("COMPRESS_LEVEL", 6))
+    app.config['ENABLE_API'] = env_flag("ENABLE_API", "1")
+    app.config['ENABLE_ADMIN'] = env_flag("ENABLE_ADMIN", "1")
+    if config is not None:
+        app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options_from_env(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    MIGRATE.init_app(app, db)
+    app.cli.add_command(import_command)
+    app.cli.add_command(export_command)
+    app.cli.add_command(rebuild_favorite_counts_command)
+    db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            configure_sqlite(db.engine)
+    replicas.init_app(app)
+    cache.init_app(app)
+    metrics.init_app(app)
+    budget.init_app(app)
+    compressor.init_app(app)
+    CORS(app, expose_headers=["X-Next-Cursor", "Link", "ETag"])
+
+    if app.config['ENABLE_API']:
+        app.register_blueprint(api)
+
+    if app.config['ENABLE_ADMIN']:
+        # Flask-Admin and its views are only imported by the processes that serve /admin
+        from admin import setup_admin
+        setup_admin(app)
+
+    return app
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
+
+@api.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(cache.stats()), 200
+
+@api.route('/compression/stats', methods=['GET'])
+def compression_stats():
+    return jsonify(compressor.to_dict()), 200
 
-@app.route('/people', methods=['GET'])
+@api.route('/pool/stats', methods=['GET'])
+def pool_status():
+    return jsonify({"pool": db.engine.pool.status(), "checkouts": pool_stats(db.engine), "replicas": replicas.to_dict()}), 200
+
+@api.route('/people', methods=['GET'])
+@query_budget(2)
+@conditional('people')
+@cache.cached('people')
 def obtener_personas():
+    where, sort = get_filter_params(request.args, People)
+    limit, after = get_page_params(request.args, len(sort))
+    fields = get_fields_params(request.args, People.PUBLIC_FIELDS)
+    if wants_stream():
+        return ndjson_response(stream_rows(db.session, People, fields, after, where, sort))
     try:
-        people_list = []
-        people = People.query.all()
+        people_list, next_cursor = keyset_rows(db.session, People, fields, limit, after, where, sort)
 
-        if people == []:
+        if people_list == [] and after is None and not where:
             return jsonify({"Error": "No se ha encontrado"}), 404
-        
-        for person in people:
-            people_list.append(person.serialize())
 
-        return jsonify(people_list), 200
+        return paginated_response(people_list, next_cursor, 200)
     
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/people/<int:people_id>', methods=['GET'])
+@api.route('/people/<int:people_id>', methods=['GET'])
+@query_budget(2)
+@conditional('people', id_arg='people_id')
+@cache.cached('people', id_arg='people_id')
 def obtener_persona_id(people_id):
+    fields = get_fields_params(request.args, People.PUBLIC_FIELDS)
     try:
-        people = People.query.get(people_id)
+        people = People.query.options(*fields_options(People, fields)).get(people_id)
 
         if not people:
             return jsonify({"Error": "No se ha encontrado"}), 404
         
-        return jsonify(people.serialize()), 200
+        return jsonify(people.serialize(fields)), 200
         
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/planets', methods=['GET'])
+@api.route('/planets', methods=['GET'])
+@query_budget(2)
+@conditional('planets')
+@cache.cached('planets')
 def obtener_planetas():
+    where, sort = get_filter_params(request.args, Planets)
+    limit, after = get_page_params(request.args, len(sort))
+    fields = get_fields_params(request.args, Planets.PUBLIC_FIELDS)
+    if wants_stream():
+        return ndjson_response(stream_rows(db.session, Planets, fields, after, where, sort))
     try:
-        planets_list = []
-        planets = Planets.query.all()
+        planets_list, next_cursor = keyset_rows(db.session, Planets, fields, limit, after, where, sort)
 
-        if not planets:
+        if not planets_list and after is None and not where:
             return jsonify({"Error": "No se ha encontrado"}), 404
-        
-        for planet in planets:
-            planets_list.append(planet.serialize())
-        
-        return jsonify(planets_list)
+
+        return paginated_response(planets_list, next_cursor)
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/vehicles', methods=['GET'])
+@api.route('/vehicles', methods=['GET'])
+@query_budget(2)
+@conditional('vehicles')
+@cache.cached('vehicles')
 def obtener_vehiculos():
+    where, sort = get_filter_params(request.args, Vehicles)
+    limit, after = get_page_params(request.args, len(sort))
+    fields = get_fields_params(request.args, Vehicles.PUBLIC_FIELDS)
+    if wants_stream():
+        return ndjson_response(stream_rows(db.session, Vehicles, fields, after, where, sort))
     try:
-        vehicles_list = []
+        vehicles_list, next_cursor = keyset_rows(db.session, Vehicles, fields, limit, after, where, sort)
 
-        vehicles = Vehicles.query.all()
-
-        if not vehicles:
+        if not vehicles_list and after is None and not where:
             return jsonify({"Error": "No se ha encontrado ningún vehiculo"}), 404
-        
-        for vehicle in vehicles:
-            vehicles_list.append(vehicle.serialize())
-        
-        return jsonify(vehicles_list), 200
+
+        return paginated_response(vehicles_list, next_cursor, 200)
+
+    except Exception as e:
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@api.route('/search', methods=['GET'])
+@query_budget(2)
+def buscar():
+    # ?q=tato&type=planets,vehicles ; the cursor is the offset of the next page
+    limit, offset = get_page_params(request.args)
+    offset = offset or 0
+    if offset < 0:
+        raise APIException("Cursor inválido", status_code=400)
+    if not search_terms(request.args.get("q")):
+        raise APIException("q es obligatorio", status_code=400)
+    types = request.args.get("type")
+    types = [name.strip() for name in types.split(",") if name.strip()] if types else list(SEARCH_TYPES)
+    unknown = [name for name in types if name not in SEARCH_TYPES]
+    if unknown or not types:
+        raise APIException("type no permitido: " + ", ".join(unknown), status_code=400)
+
+    try:
+        results, more = search(db.session, request.args["q"], types, limit, offset)
+        next_cursor = encode_cursor(offset + limit) if more else None
+        return paginated_response(results, next_cursor, 200)
+
+    except Exception as e:
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+LEADERBOARD_MAX_SIZE = 100
+
+@api.route('/leaderboard', methods=['GET'])
+@query_budget(1)
+def ranking_favoritos():
+    # ?type=planet&limit=10 ; reads the first rows of the favorite_count index, it does not count favorites
+    kind = FAVORITE_KINDS.get(request.args.get("type"))
+    if kind is None:
+        raise APIException("type debe ser " + ", ".join(FAVORITE_KINDS), status_code=400)
+    model = kind[2]
+    try:
+        limit = int(request.args.get("limit", 10))
+    except ValueError:
+        raise APIException("limit debe ser un número entero", status_code=400)
+    if limit < 1:
+        raise APIException("limit debe ser mayor que 0", status_code=400)
+
+    try:
+        rows = db.session.execute(
+            select(model.id, model.name, model.favorite_count)
+            .where(model.favorite_count > 0)
+            .order_by(model.favorite_count.desc(), model.id.desc())
+            .limit(min(limit, LEADERBOARD_MAX_SIZE))
+        ).all()
+        return jsonify([{"id": row.id, "name": row.name, "favorite_count": row.favorite_count} for row in rows]), 200
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
 
-@app.route('/planets/<int:planet_id>', methods=['GET'])
+@api.route('/planets/<int:planet_id>', methods=['GET'])
+@query_budget(2)
+@conditional('planets', id_arg='planet_id')
+@cache.cached('planets', id_arg='planet_id')
 def obtener_planeta_id(planet_id):
+    fields = get_fields_params(request.args, Planets.PUBLIC_FIELDS)
     try:
-        planet = Planets.query.get(planet_id)
+        planet = Planets.query.options(*fields_options(Planets, fields)).get(planet_id)
 
         if not planet:
             return jsonify({"Error": "No se ha encontrado"}), 404
         
-        return jsonify(planet.serialize())
+        return jsonify(planet.serialize(fields))
     
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
     
-@app.route('/users', methods=['GET'])
+@api.route('/users', methods=['GET'])
+@query_budget(5)
 def obtener_usuario():
+    limit, after = get_page_params(request.args)
+    include = get_include_params(request.args, User.INCLUDES, default=("favorites",))
+    fields = get_fields_params(request.args, User.PUBLIC_FIELDS)
+    query = User.query.options(*User.include_options(include), *fields_options(User, fields))
+    if wants_stream():
+        return ndjson_response(stream_after(query, User.id, after), lambda user: user.serialize(include, fields))
     try:
         user_list = []
-        users = User.query.all()
+        users, next_cursor = keyset_page(query, User.id, limit, after)
 
-        if users == []:
+        if users == [] and after is None:
             return jsonify({"Error": "No se ha encontrado"}), 404
         
         for user in users:
-            user_list.append(user.serialize())
+            user_list.append(user.serialize(include, fields))
 
-        return jsonify(user_list),200
+        return paginated_response(user_list, next_cursor, 200)
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/users/favorites', methods=['GET'])
+# kept for the clients that still call it, /users/<id>/favorites is the one to use
+@api.route('/users/favorites', methods=['GET'])
+@query_budget(2)
 def obtener_favoritos():
+    if wants_stream():
+        return ndjson_response(stream_after(Favorite.query.filter_by(user_id=2), Favorite.id), Favorite.serialize)
     try:
         user = User.query.get(2)
         favoritos = [favorito.serialize() for favorito in user.favoritos]
@@ -143,7 +291,64 @@ def obtener_favoritos():
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/favorite/planet/<int:planet_id>', methods=['POST'])
+@api.route('/users/<int:user_id>/favorites', methods=['GET'])
+@query_budget(2)
+def obtener_favoritos_usuario(user_id):
+    # ?planet_fields=id,name&people_fields=name ; the favorites and their planet, person
+    # and vehicle come from one SELECT with three LEFT JOINs, paginated by favorite id
+    limit, after = get_page_params(request.args)
+    fields = {
+        relation: get_fields_params(request.args, model.PUBLIC_FIELDS, relation + "_fields") or model.PUBLIC_FIELDS
+        for relation, (_, _, model) in FAVORITE_KINDS.items()
+    }
+
+    columns = [Favorite.id, Favorite.user_id, Favorite.people_id, Favorite.planet_id, Favorite.vehicle_id]
+    joined = Favorite.__table__
+    for relation, (_, column, model) in FAVORITE_KINDS.items():
+        # the id of the joined row tells an existing row apart from a LEFT JOIN miss
+        columns.append(model.id.label(relation + ".__found"))
+        columns += [getattr(model, field).label("%s.%s" % (relation, field)) for field in fields[relation]]
+        joined = joined.outerjoin(model.__table__, model.id == getattr(Favorite, column))
+    stmt = select(*columns).select_from(joined).where(Favorite.user_id == user_id)
+    if after is not None:
+        stmt = stmt.where(Favorite.id > after)
+
+    try:
+        rows = db.session.execute(stmt.order_by(Favorite.id).limit(limit + 1)).all()
+
+        if not rows and after is None and db.session.get(User, user_id) is None:
+            return jsonify({"Error": "No se ha encontrado usuario"}), 404
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].id)
+
+        favoritos = []
+        for row in rows:
+            favorito = {
+                "id": row.id,
+                "user_id": row.user_id,
+                "people_id": row.people_id,
+                "planet_id": row.planet_id,
+                "vehicle_id": row.vehicle_id
+            }
+            values = row._mapping
+            for relation in FAVORITE_KINDS:
+                # None when it is another type of favorite or the row no longer exists
+                if values[relation + ".__found"] is not None:
+                    favorito[relation] = {field: values[relation + "." + field] for field in fields[relation]}
+                else:
+                    favorito[relation] = None
+            favoritos.append(favorito)
+
+        return paginated_response(favoritos, next_cursor, 200)
+
+    except Exception as e:
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@api.route('/favorite/planet/<int:planet_id>', methods=['POST'])
+@query_budget(4)
 def agregar_fav_planeta(planet_id):
     try:
         data = request.get_json()
@@ -160,14 +365,24 @@ def agregar_fav_planeta(planet_id):
         planeta_favorito = Favorite(user_id = user_id, planet_id = planet_id) 
 
         db.session.add(planeta_favorito)
+        db.session.flush()
+        change_favorite_counts(db.session.connection(), Planets, [planet_id], 1)
         db.session.commit()
 
         return jsonify({"message": "Planeta favorito añadido con éxito"}), 200
 
+    except IntegrityError:
+        # a duplicated favorite or a user_id that does not exist (foreign key)
+        db.session.rollback()
+        if db.session.get(User, user_id) is None:
+            return jsonify({"Error": "No se ha encontrado usuario"}), 404
+        return jsonify({"Error": "El planeta ya es favorito"}), 400
+
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}, 500)
     
-@app.route('/favorite/people/<int:people_id>', methods=['POST'])
+@api.route('/favorite/people/<int:people_id>', methods=['POST'])
+@query_budget(4)
 def agregar_fav_people(people_id):
     try:
         data = request.get_json()
@@ -183,55 +398,212 @@ def agregar_fav_people(people_id):
         persona_favorita = Favorite(user_id = user_id, people_id = people_id)
 
         db.session.add(persona_favorita)
+        db.session.flush()
+        change_favorite_counts(db.session.connection(), People, [people_id], 1)
         db.session.commit()
 
         return jsonify({"message": "Persona favorita añadida con exito"})
 
+    except IntegrityError:
+        # a duplicated favorite or a user_id that does not exist (foreign key)
+        db.session.rollback()
+        if db.session.get(User, user_id) is None:
+            return jsonify({"Error": "No se ha encontrado usuario"}), 404
+        return jsonify({"Error": "La persona ya es favorita"}), 400
+
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
 
-@app.route('/favorite/planet/<int:planet_id>', methods=['DELETE'])
+def leer_ids_favoritos(data, key):
+    section = data.get(key) or {}
+    if not isinstance(section, dict):
+        raise APIException("%s debe ser un objeto" % key, status_code=400)
+
+    ids = {}
+    for name, _, _ in FAVORITE_KINDS.values():
+        values = section.get(name) or []
+        # bool is a subclass of int: true would be the id 1
+        if not isinstance(values, list) or not all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            raise APIException("%s.%s debe ser una lista de ids" % (key, name), status_code=400)
+        # the statements grow with the chunks of 500 ids, the budget of the route covers this many
+        if len(values) > current_app.config['BULK_MAX_ITEMS']:
+            raise APIException("Máximo %s ids en %s.%s" % (current_app.config['BULK_MAX_ITEMS'], key, name), status_code=400)
+        ids[name] = set(values)
+    return ids
+
+class FavoritesChanged(Exception):
+    pass
+
+def borrar_favoritos(user_id, column, ids):
+    # returns the ids whose favorite this request deleted: a concurrent removal of the
+    # same favorite must not decrement favorite_count a second time
+    target = Favorite.__table__.c[column]
+    stmt = delete(Favorite.__table__).where(Favorite.user_id == user_id, target.in_(ids))
+    if supports_delete_returning(db.session.get_bind().dialect):
+        return set(db.session.execute(stmt.returning(target)).scalars())
+    # without RETURNING the rows are locked first, the other request waits and then finds
+    # nothing to delete (SQLite has one writer at a time anyway)
+    locked = set(db.session.execute(
+        select(target).where(Favorite.user_id == user_id, target.in_(ids)).with_for_update()
+    ).scalars())
+    if not locked:
+        return locked
+    # SQLite only takes the write lock at the DELETE, a concurrent removal can still get
+    # in between: the rowcount tells how many are gone, but not which ones
+    deleted = db.session.execute(stmt.where(target.in_(locked))).rowcount
+    if deleted == len(locked):
+        return locked
+    if deleted == 0:
+        return set()
+    raise FavoritesChanged()
+
+@api.route('/favorite/batch', methods=['POST'])
+# BULK_MAX_ITEMS (5000) ids in every list are 10 chunks of 500 per list: 10 existence checks
+# and 10 counter updates per added type, 10 deletes (20 without RETURNING) and 10 counter
+# updates per removed type
+@query_budget(155)
+def sincronizar_favoritos():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise APIException("Se esperaba un objeto", status_code=400)
+
+    to_add = leer_ids_favoritos(data, "add")
+    to_remove = leer_ids_favoritos(data, "remove")
+    for name, _, _ in FAVORITE_KINDS.values():
+        if to_add[name] & to_remove[name]:
+            raise APIException("Un id no puede estar en add y remove a la vez (%s)" % name, status_code=400)
+
+    user_id = data.get("user_id")
+    if not isinstance(user_id, int) or isinstance(user_id, bool):
+        raise APIException("user_id debe ser un número entero", status_code=400)
+
+    try:
+        if db.session.get(User, user_id) is None:
+            return jsonify({"Error": "No se ha encontrado usuario"}), 404
+
+        # one IN query per type to check that the rows to add exist
+        missing = {}
+        for name, _, model in FAVORITE_KINDS.values():
+            found = set()
+            for ids in chunked(to_add[name]):
+                found.update(db.session.execute(select(model.id).where(model.id.in_(ids))).scalars())
+            if to_add[name] - found:
+                missing[name] = sorted(to_add[name] - found)
+        if missing:
+            return jsonify({"Error": "No existen", "missing": missing}), 404
+
+        # favorites the user already has are skipped, the unique indexes would reject them anyway
+        current = {name: set() for name, _, _ in FAVORITE_KINDS.values()}
+        rows = db.session.execute(
+            select(Favorite.planet_id, Favorite.people_id, Favorite.vehicle_id).where(Favorite.user_id == user_id)
+        ).all()
+        for row in rows:
+            for name, column, _ in FAVORITE_KINDS.values():
+                if getattr(row, column) is not None:
+                    current[name].add(getattr(row, column))
+
+        new_rows = []
+        removed = 0
+        for name, column, model in FAVORITE_KINDS.values():
+            added_ids = to_add[name] - current[name]
+            new_rows.extend({"user_id": user_id, column: item_id} for item_id in sorted(added_ids))
+            change_favorite_counts(db.session.connection(), model, added_ids, 1)
+
+            removed_ids = set()
+            for ids in chunked(to_remove[name] & current[name]):
+                removed_ids.update(borrar_favoritos(user_id, column, ids))
+            removed += len(removed_ids)
+            change_favorite_counts(db.session.connection(), model, removed_ids, -1)
+
+        if new_rows:
+            # executemany needs the same keys in every row
+            for row in new_rows:
+                for _, column, _ in FAVORITE_KINDS.values():
+                    row.setdefault(column, None)
+            db.session.execute(insert(Favorite), new_rows)
+
+        if new_rows or removed:
+            bump_versions(db.session.connection(), ["favorite"])
+        db.session.commit()
+
+        return jsonify({"message": "Favoritos actualizados", "added": len(new_rows), "removed": removed}), 200
+
+    except (IntegrityError, FavoritesChanged):
+        db.session.rollback()
+        return jsonify({"Error": "Los favoritos cambiaron durante la petición, vuelve a intentarlo"}), 409
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+@api.route('/favorite/planet/<int:planet_id>', methods=['DELETE'])
+@query_budget(4)
 def eliminar_fav_planeta(planet_id):
     try:
         data = request.get_json()
         user_id = data.get("user_id")
 
-        favorito = Favorite.query.filter_by(user_id = user_id, planet_id = planet_id).first()
-
-        if favorito is None:
+        # a concurrent DELETE of the same favorite finds nothing left and answers 404
+        if not borrar_favoritos(user_id, "planet_id", [planet_id]):
+            db.session.rollback()
             return jsonify({"Error": "No se ha encontrado favorito"}), 404
-        
-        db.session.delete(favorito)
+
+        change_favorite_counts(db.session.connection(), Planets, [planet_id], -1)
+        bump_versions(db.session.connection(), ["favorite"])
         db.session.commit()
 
         return jsonify({"message": "Favorito eliminado"}), 200
 
 
     except Exception as e: 
+        db.session.rollback()
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/favorite/people/<int:people_id>', methods=['DELETE'])
+@api.route('/favorite/people/<int:people_id>', methods=['DELETE'])
+@query_budget(4)
 def eliminar_fav_people(people_id):
     try:
         data = request.get_json()
         user_id = data.get("user_id")
 
-        favorito = Favorite.query.filter_by(user_id = user_id, people_id = people_id).first()
-
-        if favorito is None:
+        # a concurrent DELETE of the same favorite finds nothing left and answers 404
+        if not borrar_favoritos(user_id, "people_id", [people_id]):
+            db.session.rollback()
             return jsonify({"Error": "No se ha encontrado favorito"}), 404
-        
-        db.session.delete(favorito)
+
+        change_favorite_counts(db.session.connection(), People, [people_id], -1)
+        bump_versions(db.session.connection(), ["favorite"])
         db.session.commit()
 
         return jsonify({"message": "Favorito eliminado"}), 200
 
 
     except Exception as e: 
+        db.session.rollback()
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/planet', methods=['POST'])
+def actualizar_fila(model, item_id, values):
+    # one UPDATE ... RETURNING, the unique constraint on name replaces the SELECT that
+    # looked for duplicates (the caller turns its IntegrityError into a 400); returns
+    # None when the row does not exist
+    values = dict(values, **numeric_values(model, values))
+    stmt = update(model.__table__).where(model.id == item_id).values(values)
+    if supports_update_returning(db.session.get_bind().dialect):
+        row = db.session.execute(stmt.returning(*[getattr(model, field) for field in model.PUBLIC_FIELDS])).first()
+        updated = dict(row._mapping) if row is not None else None
+    else:
+        # without RETURNING the UPDATE alone is enough: values has every public column
+        result = db.session.execute(stmt)
+        updated = dict(values, id=item_id) if result.rowcount else None
+    if updated is None:
+        return None
+    # a Core UPDATE does not go through after_flush
+    bump_versions(db.session.connection(), [model.__tablename__])
+    return {field: updated[field] for field in model.PUBLIC_FIELDS}
+
+@api.route('/planet', methods=['POST'])
+@query_budget(3)
 def agregar_planeta():
     try:
         data = request.get_json()
@@ -244,30 +616,29 @@ def agregar_planeta():
         if not name or not gravity or not population or not terrain:
             return jsonify({"error": "name, gravity, population and terrain are required"}), 400
 
-        existing_planet = Planets.query.filter_by(name=name).first()
-        if existing_planet:
-            return jsonify({"Error": "El planeta ya existe"}), 400
-        
         new_planet = Planets(name=name, gravity=gravity, population=population, terrain=terrain)
 
         db.session.add(new_planet)
+        db.session.flush()
+        # serialized before the commit, which would expire it and cost one more SELECT
+        planet = new_planet.serialize()
         db.session.commit()
+        cache.invalidate('planets')
 
-        return jsonify({"message": "Planet created successfully", "Planet": new_planet.serialize()})
+        return jsonify({"message": "Planet created successfully", "Planet": planet})
 
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"Error": "El planeta ya existe"}), 400
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
 
-@app.route('/planet/<int:planet_id>', methods=['PUT'])
+@api.route('/planet/<int:planet_id>', methods=['PUT'])
+@query_budget(3)
 def editar_planeta(planet_id):
     try:
-
-        planeta = Planets.query.get(planet_id)
-        if not planeta:
-            return jsonify({"error": "Planeta no encontrado"}), 404
-
         data = request.get_json()
         name = data.get("name")
         gravity = data.get("gravity")
@@ -277,31 +648,24 @@ def editar_planeta(planet_id):
         if not name or not gravity or not population or not terrain:
             return jsonify({"error": "name, gravity, population and terrain are required"}), 400
 
-        existing_planet = Planets.query.filter(Planets.name == name, Planets.id != planet_id).first()
-        if existing_planet:
-            return jsonify({"Error": "El planeta ya existe"}), 400
-
-        planeta.name = name
-        planeta.gravity = gravity
-        planeta.population = population
-        planeta.terrain = terrain
+        new_planeta = actualizar_fila(Planets, planet_id, {"name": name, "gravity": gravity, "population": population, "terrain": terrain})
+        if new_planeta is None:
+            return jsonify({"error": "Planeta no encontrado"}), 404
 
         db.session.commit()
-
-        new_planeta = {
-            "id": planeta.id,
-            "name": planeta.name,
-            "gravity": planeta.gravity,
-            "population": planeta.population,
-            "terrain": planeta.terrain
-        }
+        cache.invalidate('planets', planet_id)
 
         return jsonify({"message": "Planeta actualizado", "Planeta actualizado": new_planeta}), 200
-    
+
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"Error": "El planeta ya existe"}), 400
+
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/planet/<int:planeta_id>', methods=['DELETE'])
+@api.route('/planet/<int:planeta_id>', methods=['DELETE'])
+@query_budget(6)
 def eliminar_planeta(planeta_id):
     try:
         planeta = Planets.query.get(planeta_id)
@@ -310,6 +674,7 @@ def eliminar_planeta(planeta_id):
         
         db.session.delete(planeta)
         db.session.commit()
+        cache.invalidate('planets', planeta_id)
 
         return jsonify({"message": "Planet deleted successfully"}), 200
 
@@ -318,7 +683,8 @@ def eliminar_planeta(planeta_id):
 
 
 
-@app.route('/people/', methods=['POST'])
+@api.route('/people/', methods=['POST'])
+@query_budget(3)
 def agregar_persona():
     try:
         data = request.get_json()
@@ -331,27 +697,27 @@ def agregar_persona():
         if not name or not gender or not birth_year or not mass:
             return jsonify({"error": "Name, gender and birth_year are required"}), 400
         
-        existing_people = People.query.filter_by(name = name).first()
-        if existing_people:
-            return jsonify({"error": "La persona ya existe"}), 400
-
         new_person = People(name = name, gender = gender, birth_year = birth_year, mass = mass)
 
         db.session.add(new_person)
+        db.session.flush()
+        person = new_person.serialize()
         db.session.commit()
+        cache.invalidate('people')
 
-        return jsonify({"message": "Person created successfully", "People": new_person.serialize()}), 200
+        return jsonify({"message": "Person created successfully", "People": person}), 200
+
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "La persona ya existe"}), 400
 
     except Exception as e: 
         return jsonify({"error": "Internal server error", "message": str(e)}),500
     
-@app.route('/people/<int:person_id>', methods=['PUT'])
+@api.route('/people/<int:person_id>', methods=['PUT'])
+@query_budget(3)
 def editar_persona(person_id):
     try:
-        persona = People.query.get(person_id)
-        if not persona:
-            return jsonify({"error": "Persona no encontrada"}), 404
-
         data = request.get_json()
         name = data.get("name")
         gender = data.get("gender")
@@ -361,31 +727,26 @@ def editar_persona(person_id):
         if not name or not gender or not birth_year or not mass:
             return jsonify({"error": "name, gender, birth_year y mass son requeridos"}), 400
 
-        existing_person = People.query.filter(People.name == name, People.id != person_id).first()
-        if existing_person:
-            return jsonify({"Error": "La persona ya existe"}), 400
-
-        persona.name = name
-        persona.gender = gender
-        persona.birth_year = birth_year
-        persona.mass = mass
+        updated_persona = actualizar_fila(People, person_id, {"name": name, "gender": gender, "birth_year": birth_year, "mass": mass})
+        if updated_persona is None:
+            return jsonify({"error": "Persona no encontrada"}), 404
 
         db.session.commit()
-
-        updated_persona = {
-            "id": persona.id,
-            "name": persona.name,
-            "gender": persona.gender,
-            "birth_year": persona.birth_year,
-            "mass": persona.mass
-        }
+        cache.invalidate('people', person_id)
 
         return jsonify({"message": "Persona actualizada", "Persona actualizada": updated_persona}), 200
-    
+
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"Error": "La persona ya existe"}), 400
+
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/people/<int:person_id>', methods=['DELETE'])
+@api.route('/people/<int:person_id>', methods=['DELETE'])
+# the ORM loads and unlinks the vehicles, planets and favorites of the person (one
+# statement per relation whatever its size) and bumps the version of each table
+@query_budget(12)
 def eliminar_persona(person_id):
     try:
 
@@ -395,13 +756,15 @@ def eliminar_persona(person_id):
 
         db.session.delete(persona)
         db.session.commit()
+        cache.invalidate('people', person_id)
 
         return jsonify({"message": "Persona eliminada con éxito"}), 200
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/vehicle', methods=['POST'])
+@api.route('/vehicle', methods=['POST'])
+@query_budget(3)
 def agregar_vehiculo():
     try:
         data = request.get_json()
@@ -414,10 +777,6 @@ def agregar_vehiculo():
         if not name or not model or not manufacturer or not cost_in_credits:
             return jsonify({"error": "Name, model, manufacturer, and cost_in_credits are required"}), 400
 
-        existing_vehicle = Vehicles.query.filter_by(name=name).first()
-        if existing_vehicle:
-            return jsonify({"error": "El vehiculo ya existe"}), 400
-
         new_vehicle = Vehicles(
             name = name,
             model = model,
@@ -426,60 +785,51 @@ def agregar_vehiculo():
         )
 
         db.session.add(new_vehicle)
+        db.session.flush()
+        vehicle = new_vehicle.serialize()
         db.session.commit()
+        cache.invalidate('vehicles')
+
+        return jsonify({"message": "Vehiculo creado con exito", "Vehicle": vehicle}), 201
 
-        return jsonify({"message": "Vehiculo creado con exito", "Vehicle": new_vehicle.serialize()}), 201
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"error": "El vehiculo ya existe"}), 400
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/vehicles/<int:vehicle_id>', methods=['PUT'])
+@api.route('/vehicles/<int:vehicle_id>', methods=['PUT'])
+@query_budget(3)
 def editar_vehiculo(vehicle_id):
     try:
-        
-        vehiculo = Vehicles.query.get(vehicle_id)
-        if not vehiculo:
-            return jsonify({"error": "Vehiculo no encontrado"}), 404
-
-        
         data = request.get_json()
         name = data.get("name")
         model = data.get("model")
         manufacturer = data.get("manufacturer")
         cost_in_credits = data.get("cost_in_credits")
 
-        
         if not name or not model or not manufacturer or not cost_in_credits:
             return jsonify({"error": "name, model, manufacturer y cost_in_credits son requeridos"}), 400
 
-        
-        existing_vehicle = Vehicles.query.filter(Vehicles.name == name, Vehicles.id != vehicle_id).first()
-        if existing_vehicle:
-            return jsonify({"Error": "El vehiculo ya existe"}), 400
-
-        
-        vehiculo.name = name
-        vehiculo.model = model
-        vehiculo.manufacturer = manufacturer
-        vehiculo.cost_in_credits = cost_in_credits
+        updated_vehiculo = actualizar_fila(Vehicles, vehicle_id, {"name": name, "model": model, "manufacturer": manufacturer, "cost_in_credits": cost_in_credits})
+        if updated_vehiculo is None:
+            return jsonify({"error": "Vehiculo no encontrado"}), 404
 
         db.session.commit()
-
-        updated_vehiculo = {
-            "id": vehiculo.id,
-            "name": vehiculo.name,
-            "model": vehiculo.model,
-            "manufacturer": vehiculo.manufacturer,
-            "cost_in_credits": vehiculo.cost_in_credits
-        }
+        cache.invalidate('vehicles', vehicle_id)
 
         return jsonify({"message": "Vehiculo actualizado", "Vehiculo actualizado": updated_vehiculo}), 200
 
-    except Exception as e:
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({"Error": "El vehiculo ya existe"}), 400
 
+    except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
-@app.route('/vehicles/<int:vehicle_id>', methods=['DELETE'])
+@api.route('/vehicles/<int:vehicle_id>', methods=['DELETE'])
+@query_budget(6)
 def eliminar_vehiculo(vehicle_id):
     try:
 
@@ -490,14 +840,112 @@ def eliminar_vehiculo(vehicle_id):
 
         db.session.delete(vehiculo)
         db.session.commit()
+        cache.invalidate('vehicles', vehicle_id)
 
         return jsonify({"message": "Vehiculo eliminado con exito"}), 200
 
     except Exception as e:
         return jsonify({"error": "Internal server error", "message": str(e)}), 500
 
+def crear_en_lote(model, namespace):
+    # mode=atomic: nothing is written if any item fails, mode=partial: valid items are written
+    mode = request.args.get("mode", "atomic")
+    if mode not in ("atomic", "partial"):
+        raise APIException("mode debe ser atomic o partial", status_code=400)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list) or not data:
+        raise APIException("Se esperaba una lista de objetos", status_code=400)
+    if len(data) > current_app.config['BULK_MAX_ITEMS']:
+        raise APIException("Máximo %s elementos por lote" % current_app.config['BULK_MAX_ITEMS'], status_code=400)
+
+    results = []
+    candidates = []
+    names_in_batch = set()
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            results.append({"index": index, "status": "error", "error": "El elemento debe ser un objeto"})
+            continue
+
+        missing = [field for field in model.REQUIRED_FIELDS if not item.get(field)]
+        # the columns are strings: numbers are accepted, objects, lists and booleans are not
+        not_scalar = [field for field in model.REQUIRED_FIELDS if field not in missing
+                      and (isinstance(item[field], bool) or not isinstance(item[field], (str, int, float)))]
+        if missing:
+            results.append({"index": index, "status": "error", "error": ", ".join(missing) + " son requeridos"})
+        elif not_scalar:
+            results.append({"index": index, "status": "error", "error": ", ".join(not_scalar) + " deben ser un texto o un número"})
+        elif not isinstance(item["name"], str):
+            results.append({"index": index, "status": "error", "error": "name debe ser un texto"})
+        elif item["name"] in names_in_batch:
+            results.append({"index": index, "status": "error", "error": "Nombre repetido en el lote"})
+        else:
+            names_in_batch.add(item["name"])
+            results.append({"index": index, "status": "created"})
+            candidates.append((index, {field: str(item[field]) for field in model.REQUIRED_FIELDS}))
+
+    try:
+        # one set based query per chunk instead of one SELECT per item
+        existing = set()
+        for names in chunked(names_in_batch):
+            existing.update(db.session.execute(select(model.name).where(model.name.in_(names))).scalars())
+
+        rows = []
+        for index, row in candidates:
+            if row["name"] in existing:
+                results[index] = {"index": index, "status": "error", "error": "Ya existe"}
+            else:
+                rows.append(dict(row, **numeric_values(model, row)))
+
+        failed = len(data) - len(rows)
+        if failed and (mode == "atomic" or not rows):
+            for result in results:
+                if result["status"] == "created":
+                    result["status"] = "skipped"
+            return jsonify({"created": 0, "failed": failed, "results": results}), 400
+
+        db.session.execute(insert(model), rows)
+        bump_versions(db.session.connection(), [model.__tablename__])
+
+        ids = {}
+        for names in chunked([row["name"] for row in rows]):
+            ids.update(db.session.execute(select(model.name, model.id).where(model.name.in_(names))).all())
+        db.session.commit()
+
+    except IntegrityError:
+        # somebody inserted one of the names after our check, nothing was written
+        db.session.rollback()
+        return jsonify({"Error": "Conflicto de nombres con otra escritura, vuelve a intentarlo"}), 409
+
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": "Internal server error", "message": str(e)}), 500
+
+    cache.invalidate(namespace)
+
+    for result in results:
+        if result["status"] == "created":
+            result["id"] = ids[data[result["index"]]["name"]]
+
+    return jsonify({"created": len(rows), "failed": failed, "results": results}), 207 if failed else 201
+
+@api.route('/planet/bulk', methods=['POST'])
+@query_budget(25)
+def agregar_planetas_en_lote():
+    return crear_en_lote(Planets, 'planets')
+
+@api.route('/people/bulk', methods=['POST'])
+@query_budget(25)
+def agregar_personas_en_lote():
+    return crear_en_lote(People, 'people')
+
+@api.route('/vehicle/bulk', methods=['POST'])
+@query_budget(25)
+def agregar_vehiculos_en_lote():
+    return crear_en_lote(Vehicles, 'vehicles')
+
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
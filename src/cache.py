@@ -0,0 +1,170 @@
+"""
+Read-through cache for the GET responses of the catalog (planets, people, vehicles).
+
+The backend is pluggable: anything with get/set/delete_prefix/clear works, for example
+a small wrapper around redis if several workers must share the same entries.
+
+The keys carry the table_version of the namespace (the same number the ETag is built
+from), so a write made anywhere (another worker, Flask-Admin, flask import) turns the
+old entries into misses; invalidate() only frees their memory sooner in this process.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, make_response, Response
+from models import get_table_version
+from utils import wants_stream
+
+CACHED_HEADERS = ("Content-Type", "X-Next-Cursor", "Link", "Vary")
+
+class LRUCache:
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            # size bounded: drop the least recently used entries
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+class CacheState:
+    # what one app keeps: create_app() can run more than once in a process (tests, benchmarks)
+    def __init__(self, backend, enabled):
+        self.backend = backend
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+class ResponseCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_ENABLED", True)
+        app.config.setdefault("CACHE_BACKEND", "memory")
+        app.config.setdefault("CACHE_TTL", 60)
+        app.config.setdefault("CACHE_MAX_ENTRIES", 1024)
+
+        enabled = app.config["CACHE_ENABLED"]
+        backend = app.config["CACHE_BACKEND"]
+        if not enabled or backend == "null":
+            backend = NullCache()
+        elif backend == "memory":
+            backend = LRUCache(app.config["CACHE_MAX_ENTRIES"], app.config["CACHE_TTL"])
+        # else: an already built backend object (shared cache)
+        app.extensions["response_cache"] = CacheState(backend, enabled)
+
+    @property
+    def state(self):
+        state = current_app.extensions.get("response_cache")
+        return state if state is not None else DISABLED
+
+    @property
+    def backend(self):
+        return self.state.backend
+
+    def _count(self, state, hit):
+        with state.lock:
+            if hit:
+                state.hits += 1
+            else:
+                state.misses += 1
+
+    def cached(self, namespace, id_arg=None):
+        # list keys: "<namespace>:list:v<version>:<path?query>",
+        # detail keys: "<namespace>:item:<id>:v<version>:<path?query>"
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                state = self.state
+                if not state.enabled or wants_stream():
+                    return view(*args, **kwargs)
+
+                version = get_table_version(namespace)
+                if id_arg is None:
+                    key = "%s:list:v%s:%s" % (namespace, version, request.full_path)
+                else:
+                    key = "%s:item:%s:v%s:%s" % (namespace, kwargs[id_arg], version, request.full_path)
+
+                entry = state.backend.get(key)
+                if entry is not None:
+                    self._count(state, True)
+                    body, status, headers = entry
+                    return Response(body, status=status, headers=headers)
+
+                self._count(state, False)
+                response = make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+                    state.backend.set(key, (response.get_data(), response.status_code, headers))
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, namespace, item_id=None):
+        # any write changes the lists; only the touched row changes its detail entry
+        backend = self.backend
+        backend.delete_prefix("%s:list:" % namespace)
+        if item_id is not None:
+            backend.delete_prefix("%s:item:%s:" % (namespace, item_id))
+
+    def stats(self):
+        state = self.state
+        return {
+            "enabled": state.enabled,
+            "hits": state.hits,
+            "misses": state.misses,
+            "entries": len(state.backend)
+        }
+
+DISABLED = CacheState(NullCache(), False)
+
+cache = ResponseCache()
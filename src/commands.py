@@ -0,0 +1,332 @@
+"""
+Flask CLI commands to load catalog data and to extract snapshots of every table:
+
+    $ flask import people data/people.ndjson
+    $ flask import vehicles data/vehicles.csv.gz --batch-size 10000
+    $ flask import planets data/planets.json
+    $ flask export --output-dir backups --gzip --jobs 3
+    $ flask export people vehicles --format csv --since people=1200
+    $ flask rebuild-favorite-counts
+
+Files are read as a stream (NDJSON, CSV or a JSON array, optionally gzipped) and
+upserted by name in batches, one transaction per batch, so memory stays bounded
+on multi-GB inputs. Vehicles and planets may reference their person by name with
+a "people_name" column, the names of every batch are resolved with one query.
+Each batch bumps the table version, so the ETags of the API change and the response
+cache of the running workers misses (its keys carry the version).
+
+Exports read every table through a server-side cursor (stream_results), each table on
+its own connection, and write one file per table. There are no timestamp columns, so
+--since is an id watermark: the last id of each table is printed at the end, pass it
+back to extract only the rows added since then.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, bindparam
+from models import db, User, People, Planets, Vehicles, Favorite, bump_versions, numeric_values, rebuild_favorite_counts
+
+IMPORT_MODELS = {"people": People, "planets": Planets, "vehicles": Vehicles}
+
+EXPORT_MODELS = {"user": User, "people": People, "planets": Planets, "vehicles": Vehicles, "favorite": Favorite}
+
+# columns that never leave the database
+EXPORT_EXCLUDED_COLUMNS = {"user": ("password",)}
+
+EXPORT_BATCH_SIZE = 5000
+
+# column of each model that points to People
+PEOPLE_FOREIGN_KEYS = {"planets": "id_people", "vehicles": "people_id"}
+
+def open_input(path):
+    if path.endswith(".gz"):
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+def detect_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    for extension, file_format in ((".ndjson", "ndjson"), (".jsonl", "ndjson"), (".csv", "csv"), (".json", "json")):
+        if name.endswith(extension):
+            return file_format
+    raise click.BadParameter("No se reconoce el formato de %s, usa --format" % path)
+
+class InvalidItem:
+    # an input line that could not be decoded, reported with the skipped rows
+    def __init__(self, error):
+        self.error = error
+
+def read_ndjson(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as error:
+            yield InvalidItem("línea %d: JSON inválido (%s)" % (number, error))
+
+def read_json_array(stream, chunk_size=1 << 16):
+    # decodes the items of a top level array one by one, without loading the whole file
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    for chunk in iter(lambda: stream.read(chunk_size), ""):
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != "[":
+                    raise click.ClickException("El JSON debe ser una lista de objetos")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the item continues in the next chunk
+                break
+            yield item
+        buffer = buffer[position:]
+    if buffer.strip():
+        raise click.ClickException("El JSON está incompleto")
+
+READERS = {"ndjson": read_ndjson, "csv": csv.DictReader, "json": read_json_array}
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def resolve_people(connection, names):
+    people_ids = {}
+    names = list(names)
+    for start in range(0, len(names), 500):
+        chunk = names[start:start + 500]
+        people_ids.update(connection.execute(select(People.name, People.id).where(People.name.in_(chunk))).all())
+    return people_ids
+
+def prepare_rows(connection, table_name, model, items):
+    foreign_key = PEOPLE_FOREIGN_KEYS.get(table_name)
+    people_ids = {}
+    if foreign_key:
+        names = set(item["people_name"] for item in items if isinstance(item, dict) and isinstance(item.get("people_name"), str))
+        people_ids = resolve_people(connection, names)
+
+    rows = []
+    errors = []
+    for item in items:
+        if isinstance(item, InvalidItem):
+            errors.append(item.error)
+            continue
+        if not isinstance(item, dict):
+            errors.append("no es un objeto: %r" % (item,))
+            continue
+        missing = [field for field in model.REQUIRED_FIELDS if not item.get(field)]
+        if missing:
+            errors.append("%s: faltan %s" % (item.get("name"), ", ".join(missing)))
+            continue
+        not_scalar = [field for field in model.REQUIRED_FIELDS if isinstance(item[field], (bool, dict, list))]
+        if not_scalar:
+            errors.append("%s: %s deben ser un texto o un número" % (item["name"], ", ".join(not_scalar)))
+            continue
+
+        row = {field: str(item[field]) for field in model.REQUIRED_FIELDS}
+        # without people_name or the foreign key in the input the row keeps its current link
+        if foreign_key and ("people_name" in item or foreign_key in item):
+            if item.get("people_name"):
+                if not isinstance(item["people_name"], str) or item["people_name"] not in people_ids:
+                    errors.append("%s: no existe la persona %s" % (item["name"], item["people_name"]))
+                    continue
+                row[foreign_key] = people_ids[item["people_name"]]
+            elif item.get(foreign_key) in (None, ""):
+                row[foreign_key] = None
+            else:
+                try:
+                    if isinstance(item[foreign_key], bool):
+                        raise TypeError(item[foreign_key])
+                    row[foreign_key] = int(item[foreign_key])
+                except (TypeError, ValueError):
+                    errors.append("%s: %s debe ser un número entero" % (item["name"], foreign_key))
+                    continue
+        row.update(numeric_values(model, row))
+        rows.append(row)
+
+    # the last occurrence of a repeated name wins, as it would with one upsert per row
+    return list({row["name"]: row for row in rows}.values()), errors
+
+def upsert(connection, model, rows):
+    # executemany needs the same columns in every row, and a row only updates the columns it has
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        upsert_group(connection, model, group)
+
+def upsert_group(connection, model, rows):
+    table = model.__table__
+    columns = [column for column in rows[0] if column != "name"]
+    dialect = connection.dialect.name
+
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        # executemany of INSERT ... ON CONFLICT (name) DO UPDATE, psycopg2 sends it as multi-row VALUES pages
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=["name"], set_={column: stmt.excluded[column] for column in columns})
+        connection.execute(stmt, rows)
+        return
+
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(table)
+        stmt = stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in columns})
+        connection.execute(stmt, rows)
+        return
+
+    # other dialects: one query to split the batch, then one executemany per statement
+    existing = set()
+    names = [row["name"] for row in rows]
+    for start in range(0, len(names), 500):
+        existing.update(connection.execute(select(table.c.name).where(table.c.name.in_(names[start:start + 500]))).scalars())
+    new_rows = [row for row in rows if row["name"] not in existing]
+    old_rows = [dict(row, _name=row["name"]) for row in rows if row["name"] in existing]
+    if new_rows:
+        connection.execute(table.insert(), new_rows)
+    if old_rows:
+        connection.execute(
+            update(table).where(table.c.name == bindparam("_name")).values({column: bindparam(column) for column in columns}),
+            old_rows
+        )
+
+@click.command("import")
+@click.argument("table", type=click.Choice(sorted(IMPORT_MODELS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "file_format", type=click.Choice(sorted(READERS)), help="Por defecto se deduce de la extensión.")
+@click.option("--batch-size", default=5000, show_default=True, help="Filas por transacción.")
+@with_appcontext
+def import_command(table, path, file_format, batch_size):
+    """Importa (upsert por name) un fichero NDJSON, CSV o JSON en people, planets o vehicles."""
+    model = IMPORT_MODELS[table]
+    file_format = file_format or detect_format(path)
+
+    started = time.perf_counter()
+    read = upserted = skipped = 0
+    with open_input(path) as stream:
+        for batch in batches(READERS[file_format](stream), batch_size):
+            read += len(batch)
+            with db.engine.begin() as connection:
+                rows, errors = prepare_rows(connection, table, model, batch)
+                if rows:
+                    upsert(connection, model, rows)
+                    bump_versions(connection, [table])
+            upserted += len(rows)
+            skipped += len(errors)
+            for error in errors[:5]:
+                click.echo("  omitida: %s" % error, err=True)
+
+            elapsed = time.perf_counter() - started
+            click.echo("%d filas leídas, %d importadas, %d omitidas (%.0f filas/s)" % (read, upserted, skipped, read / elapsed))
+
+    elapsed = time.perf_counter() - started
+    click.echo("Terminado en %.1fs: %d filas importadas, %d omitidas, %.0f filas/s" % (elapsed, upserted, skipped, read / max(elapsed, 1e-9)))
+
+def parse_since(values, tables):
+    # "1200" applies to every table, "people=1200" only to people and wins over it
+    since = {}
+    for value in sorted(values, key=lambda value: "=" in value):
+        table, _, watermark = value.rpartition("=")
+        if table and table not in EXPORT_MODELS:
+            raise click.BadParameter("No existe la tabla %s" % table, param_hint="--since")
+        try:
+            watermark = int(watermark)
+        except ValueError:
+            raise click.BadParameter("%s no es un id" % value, param_hint="--since")
+        for name in ([table] if table else tables):
+            since[name] = watermark
+    return since
+
+def open_output(path, compress):
+    if compress:
+        return io.TextIOWrapper(gzip.open(path, "wb"), encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+def export_table(engine, table_name, path, file_format, compress, since):
+    table = EXPORT_MODELS[table_name].__table__
+    columns = [column for column in table.columns if column.name not in EXPORT_EXCLUDED_COLUMNS.get(table_name, ())]
+    names = [column.name for column in columns]
+    stmt = select(*columns).order_by(table.c.id)
+    if since is not None:
+        stmt = stmt.where(table.c.id > since)
+
+    started = time.perf_counter()
+    count = 0
+    last_id = since
+    # a connection per table: the exports of a --jobs run do not share a cursor or a transaction
+    with engine.connect() as connection, open_output(path, compress) as output:
+        if file_format == "csv":
+            writer = csv.writer(output)
+            writer.writerow(names)
+        result = connection.execution_options(stream_results=True).execute(stmt)
+        for partition in result.partitions(EXPORT_BATCH_SIZE):
+            if file_format == "csv":
+                writer.writerows(partition)
+            else:
+                output.write("".join(json.dumps(dict(zip(names, row)), separators=(",", ":")) + "\n" for row in partition))
+            count += len(partition)
+            last_id = partition[-1].id
+    return table_name, count, last_id, time.perf_counter() - started
+
+@click.command("export")
+@click.argument("tables", nargs=-1, type=click.Choice(sorted(EXPORT_MODELS)))
+@click.option("--output-dir", default=".", show_default=True, type=click.Path(file_okay=False))
+@click.option("--format", "file_format", type=click.Choice(["csv", "ndjson"]), default="ndjson", show_default=True)
+@click.option("--gzip", "compress", is_flag=True, help="Comprime los ficheros con gzip.")
+@click.option("--since", multiple=True, help="Solo filas con id mayor: ID para todas las tablas o TABLA=ID.")
+@click.option("--jobs", default=1, show_default=True, help="Tablas exportadas a la vez, cada una con su conexión.")
+@with_appcontext
+def export_command(tables, output_dir, file_format, compress, since, jobs):
+    """Exporta las tablas (todas por defecto) a NDJSON o CSV, un fichero por tabla. User sale sin password."""
+    tables = list(tables) or list(EXPORT_MODELS)
+    since = parse_since(since, tables)
+    os.makedirs(output_dir, exist_ok=True)
+    extension = file_format + (".gz" if compress else "")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [
+            executor.submit(export_table, db.engine, table, os.path.join(output_dir, "%s.%s" % (table, extension)),
+                            file_format, compress, since.get(table))
+            for table in tables
+        ]
+        for future in futures:
+            table, count, last_id, elapsed = future.result()
+            click.echo("%s: %d filas en %.1fs (%.0f filas/s), último id %s" % (table, count, elapsed, count / max(elapsed, 1e-9), last_id))
+
+    click.echo("Terminado en %.1fs" % (time.perf_counter() - started))
+
+@click.command("rebuild-favorite-counts")
+@with_appcontext
+def rebuild_favorite_counts_command():
+    """Recalcula favorite_count de planets, people y vehicles a partir de la tabla favorite."""
+    with db.engine.begin() as connection:
+        fixed = rebuild_favorite_counts(connection)
+    for table, count in fixed.items():
+        click.echo("%s: %d filas corregidas" % (table, count))
@@ -0,0 +1,135 @@
+"""
+Compression of the JSON responses, negotiated with Accept-Encoding.
+
+gzip is always there; brotli ("br") and zstd are offered when the brotli or zstandard
+packages are installed. Bodies under COMPRESS_MIN_SIZE bytes go out as they are, and
+streamed responses (NDJSON) are never buffered to compress them.
+
+The compressed bodies are kept in an LRU keyed by encoding and SHA-1 of the body: an
+unchanged catalog list is hashed again, which is much cheaper than compressing it again.
+"""
+import gzip
+import hashlib
+import threading
+import time
+from flask import current_app, request
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/html", "text/plain")
+
+def available_encodings():
+    # in order of preference when the client accepts several with the same q
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+class EncodingStats:
+    def __init__(self):
+        self.responses = 0
+        self.cache_hits = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def to_dict(self):
+        return {
+            "responses": self.responses,
+            "cache_hits": self.cache_hits,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "ratio": round(self.bytes_in / self.bytes_out, 3) if self.bytes_out else None,
+            "cpu_seconds": round(self.cpu_seconds, 6),
+        }
+
+class CompressionState:
+    def __init__(self, encodings, max_entries):
+        self.cache = LRUCache(max_entries, 3600)
+        self.stats = {encoding: EncodingStats() for encoding in encodings}
+        self.lock = threading.Lock()
+
+class Compressor:
+    def __init__(self, app=None):
+        self.encodings = available_encodings()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESS_ENABLED", True)
+        app.config.setdefault("COMPRESS_MIN_SIZE", 500)
+        # gzip 1-9, brotli quality 0-11, zstd 1-22
+        app.config.setdefault("COMPRESS_LEVEL", 6)
+        app.config.setdefault("COMPRESS_BROTLI_QUALITY", 5)
+        app.config.setdefault("COMPRESS_ZSTD_LEVEL", 3)
+        app.config.setdefault("COMPRESS_CACHE_MAX_ENTRIES", 256)
+        app.extensions["compression"] = CompressionState(self.encodings, app.config["COMPRESS_CACHE_MAX_ENTRIES"])
+        if not app.config["COMPRESS_ENABLED"]:
+            return
+
+        # registered after the metrics, so it runs before them and its time is in the latency
+        app.after_request(self._compress)
+
+    def compress(self, encoding, body, config):
+        if encoding == "gzip":
+            # mtime=0: the same body always gives the same bytes
+            return gzip.compress(body, compresslevel=config["COMPRESS_LEVEL"], mtime=0)
+        if encoding == "br":
+            return brotli.compress(body, quality=config["COMPRESS_BROTLI_QUALITY"])
+        return zstandard.ZstdCompressor(level=config["COMPRESS_ZSTD_LEVEL"]).compress(body)
+
+    def _compress(self, response):
+        if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+                or "Content-Encoding" in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+
+        # the body depends on Accept-Encoding, even when this one goes out uncompressed
+        response.vary.add("Accept-Encoding")
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        body = response.get_data()
+        if len(body) < current_app.config["COMPRESS_MIN_SIZE"]:
+            return response
+
+        state = current_app.extensions["compression"]
+        # the hash is part of the cost of a cache hit
+        started = time.thread_time()
+        key = "%s:%s" % (encoding, hashlib.sha1(body).hexdigest())
+        compressed = state.cache.get(key)
+        hit = compressed is not None
+        if not hit:
+            compressed = self.compress(encoding, body, current_app.config)
+            state.cache.set(key, compressed)
+        cpu_seconds = time.thread_time() - started
+
+        with state.lock:
+            stats = state.stats[encoding]
+            stats.responses += 1
+            stats.cache_hits += hit
+            stats.bytes_in += len(body)
+            stats.bytes_out += len(compressed)
+            stats.cpu_seconds += cpu_seconds
+
+        response.set_data(compressed)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    def to_dict(self):
+        state = current_app.extensions["compression"]
+        with state.lock:
+            return {encoding: stats.to_dict() for encoding, stats in state.stats.items()}
+
+compressor = Compressor()
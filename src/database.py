@@ -0,0 +1,108 @@
+"""
+Engine and pool settings read from the environment, SQLite pragmas and pool checkout stats.
+
+With gunicorn every worker has its own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections; the wait and exhausted
+counters in /pool/stats tell if the pool (or the worker count) is too small.
+"""
+import os
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+def env_flag(name, default):
+    return os.getenv(name, default) not in ("0", "false", "False", "")
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.exhausted = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, waited, exhausted, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            if exhausted:
+                self.exhausted += 1
+            if timed_out:
+                self.timeouts += 1
+
+    def to_dict(self):
+        return {
+            "checkouts": self.checkouts,
+            "wait_seconds_total": round(self.wait_seconds, 6),
+            "wait_seconds_max": round(self.max_wait_seconds, 6),
+            "exhausted": self.exhausted,
+            "timeouts": self.timeouts
+        }
+
+def pool_stats(engine):
+    # every engine (primary, replicas) counts on its own; SQLite does not use this pool
+    stats = getattr(engine.pool, "stats", None)
+    return (stats or PoolStats()).to_dict()
+
+class InstrumentedQueuePool(QueuePool):
+    # QueuePool that measures how long every checkout waited for a connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def recreate(self):
+        # engine.dispose() replaces the pool, the counters carry on
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        # every connection (pool + overflow) is in use, this checkout has to wait
+        exhausted = self._max_overflow > -1 and self.checkedout() >= self.size() + self._max_overflow
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.stats.record(time.perf_counter() - start, exhausted, timed_out=True)
+            raise
+        self.stats.record(time.perf_counter() - start, exhausted)
+        return connection
+
+def engine_options_from_env(database_url):
+    if database_url.startswith("sqlite"):
+        # SQLite does not use a QueuePool, its tuning happens in the pragmas
+        return {}
+    return {
+        "poolclass": InstrumentedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": env_flag("DB_POOL_PRE_PING", "1"),
+    }
+
+def configure_sqlite(engine):
+    cache_size_kb = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))
+    mmap_size = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers work while somebody writes; NORMAL is safe with WAL
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        # a negative cache_size is in KiB instead of pages
+        cursor.execute("PRAGMA cache_size=%d" % -cache_size_kb)
+        cursor.execute("PRAGMA mmap_size=%d" % mmap_size)
+        cursor.close()
+
+def supports_update_returning(dialect):
+    # SQLAlchemy 2.0 names it update_returning (SQLite >= 3.35 has it), 1.4 full_returning
+    return bool(getattr(dialect, "update_returning", getattr(dialect, "full_returning", False)))
+
+def supports_delete_returning(dialect):
+    return bool(getattr(dialect, "delete_returning", getattr(dialect, "full_returning", False)))
@@ -0,0 +1,37 @@
+"""
+Conditional GET for the catalog: the ETag is built from the table_version counter, so a
+matching If-None-Match is answered with 304 before any row is loaded or serialized.
+"""
+import hashlib
+from functools import wraps
+from flask import request, make_response, Response
+from models import get_table_version
+from utils import wants_stream
+
+def build_etag(table, item_id=None):
+    version = get_table_version(table)
+    if item_id is not None and not request.query_string:
+        return "%s-%s-%s" % (table, version, item_id)
+    # the same resource with other query params (page, limit...) or as NDJSON is a different representation
+    representation = request.full_path + ("|ndjson" if wants_stream() else "|json")
+    digest = hashlib.sha1(representation.encode()).hexdigest()[:12]
+    if item_id is not None:
+        return "%s-%s-%s-%s" % (table, version, item_id, digest)
+    return "%s-%s-%s" % (table, version, digest)
+
+def conditional(table, id_arg=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = build_etag(table, kwargs[id_arg] if id_arg else None)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+            return response
+        return wrapper
+    return decorator
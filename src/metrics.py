@@ -0,0 +1,230 @@
+"""
+Request metrics in Prometheus text format at /metrics.
+
+Every thread writes only to its own counters (no lock on the request path); /metrics
+adds up the counters of all the threads when it is scraped. When a thread ends (flask run
+and app.run() start one per request) its counters are added to a shared total and
+dropped, so the list stays as long as the number of live threads. Each gunicorn worker
+keeps its own numbers, so the scraper sees the worker that answered.
+"""
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from flask import current_app, g, request, Response, has_request_context
+from sqlalchemy import event
+from models import db
+from cache import cache
+from database import pool_stats
+from compression import compressor
+from replicas import replicas
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, buckets, value):
+        self.counts[bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class ThreadStats:
+    def __init__(self):
+        self.requests = {}
+        self.latency = {}
+        self.statements = {}
+        self.sql_statements = {}
+        self.sql_seconds = {}
+
+    def add(self, other):
+        for key, value in dict(other.requests).items():
+            self.requests[key] = self.requests.get(key, 0) + value
+        for name in ("sql_statements", "sql_seconds"):
+            target = getattr(self, name)
+            for key, value in dict(getattr(other, name)).items():
+                target[key] = target.get(key, 0) + value
+        for name, buckets in (("latency", LATENCY_BUCKETS), ("statements", STATEMENT_BUCKETS)):
+            target = getattr(self, name)
+            for key, histogram in dict(getattr(other, name)).items():
+                merged = target.setdefault(key, Histogram(buckets))
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+
+class ThreadToken:
+    # lives only in the thread-local storage, it is freed when its thread ends
+    pass
+
+class MetricsState:
+    # the counters of one app, in app.extensions["metrics"]
+    def __init__(self):
+        self.local = threading.local()
+        self.threads = []
+        self.finished = ThreadStats()
+        self.lock = threading.Lock()
+
+    def retire(self, stats):
+        # the thread is gone, nobody writes to its counters any more
+        with self.lock:
+            self.finished.add(stats)
+            self.threads.remove(stats)
+
+class Metrics:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("METRICS_ENABLED", True)
+        if not app.config["METRICS_ENABLED"]:
+            return
+
+        app.extensions["metrics"] = MetricsState()
+        app.before_request(self._start_request)
+        app.after_request(self._remember_status)
+        # after_request is skipped when the view raises, teardown_request always runs
+        app.teardown_request(self._end_request)
+        app.add_url_rule("/metrics", "metrics", self.render, methods=["GET"])
+
+        with app.app_context():
+            # the reads sent to a replica count in the statements of the request too
+            for engine in [db.engine] + replicas.engines:
+                event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _stats(self):
+        state = current_app.extensions["metrics"]
+        stats = getattr(state.local, "stats", None)
+        if stats is None:
+            stats = state.local.stats = ThreadStats()
+            state.local.token = ThreadToken()
+            weakref.finalize(state.local.token, state.retire, stats)
+            # the lock is only taken the first time a thread records something
+            with state.lock:
+                state.threads.append(stats)
+        return stats
+
+    def _start_request(self):
+        g.request_started = time.perf_counter()
+        g.sql_statements = 0
+        g.sql_seconds = 0.0
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_started", None)
+        if started is not None and has_request_context() and "sql_statements" in g:
+            g.sql_statements += 1
+            g.sql_seconds += time.perf_counter() - started
+
+    def _remember_status(self, response):
+        # runs again for the 500 of the error handler when a later after_request raises
+        g.response_status = response.status_code
+        return response
+
+    def _end_request(self, error):
+        if "request_started" not in g:
+            return
+
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or "unmatched"
+        stats = self._stats()
+
+        status = 500 if error is not None else g.get("response_status", 500)
+        key = (endpoint, request.method, status)
+        stats.requests[key] = stats.requests.get(key, 0) + 1
+        stats.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(LATENCY_BUCKETS, elapsed)
+        stats.statements.setdefault(endpoint, Histogram(STATEMENT_BUCKETS)).observe(STATEMENT_BUCKETS, g.sql_statements)
+        stats.sql_statements[endpoint] = stats.sql_statements.get(endpoint, 0) + g.sql_statements
+        stats.sql_seconds[endpoint] = stats.sql_seconds.get(endpoint, 0.0) + g.sql_seconds
+
+    def collect(self):
+        state = current_app.extensions["metrics"]
+        totals = ThreadStats()
+        with state.lock:
+            totals.add(state.finished)
+            threads = list(state.threads)
+
+        for stats in threads:
+            totals.add(stats)
+        return totals
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+
+        lines.append("# HELP http_requests_total Requests by endpoint, method and status code.")
+        lines.append("# TYPE http_requests_total counter")
+        for (endpoint, method, status), value in sorted(totals.requests.items()):
+            lines.append('http_requests_total{endpoint="%s",method="%s",status="%s"} %d' % (endpoint, method, status, value))
+
+        write_histograms(lines, "http_request_duration_seconds", "Request latency by endpoint.", totals.latency, LATENCY_BUCKETS)
+        write_histograms(lines, "db_statements_per_request", "SQL statements run by each request.", totals.statements, STATEMENT_BUCKETS)
+
+        lines.append("# HELP db_statements_total SQL statements by endpoint.")
+        lines.append("# TYPE db_statements_total counter")
+        for endpoint, value in sorted(totals.sql_statements.items()):
+            lines.append('db_statements_total{endpoint="%s"} %d' % (endpoint, value))
+
+        lines.append("# HELP db_statement_seconds_total Time spent in SQL by endpoint.")
+        lines.append("# TYPE db_statement_seconds_total counter")
+        for endpoint, value in sorted(totals.sql_seconds.items()):
+            lines.append('db_statement_seconds_total{endpoint="%s"} %.6f' % (endpoint, value))
+
+        cache_stats = cache.stats()
+        for name, help_text, value in (
+            ("cache_hits_total", "Response cache hits.", cache_stats["hits"]),
+            ("cache_misses_total", "Response cache misses.", cache_stats["misses"]),
+        ):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            lines.append("%s %s" % (name, value))
+
+        # one series per engine: the primary and every replica have their own pool
+        pools = [("primary", pool_stats(db.engine))]
+        pools += [("replica%d" % number, pool_stats(engine)) for number, engine in enumerate(replicas.engines)]
+        for name, key, help_text in (
+            ("db_pool_checkouts_total", "checkouts", "Connections taken from the pool."),
+            ("db_pool_wait_seconds_total", "wait_seconds_total", "Time spent waiting for a pool connection."),
+            ("db_pool_exhausted_total", "exhausted", "Checkouts that found the pool exhausted."),
+            ("db_pool_timeouts_total", "timeouts", "Checkouts that timed out."),
+        ):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for engine, stats in pools:
+                lines.append('%s{engine="%s"} %s' % (name, engine, stats[key]))
+
+        compression = compressor.to_dict()
+        for name, key, help_text in (
+            ("http_compression_responses_total", "responses", "Compressed responses by encoding."),
+            ("http_compression_cache_hits_total", "cache_hits", "Compressed bodies served from the cache."),
+            ("http_compression_bytes_in_total", "bytes_in", "Bytes before compression."),
+            ("http_compression_bytes_out_total", "bytes_out", "Bytes after compression."),
+            ("http_compression_cpu_seconds_total", "cpu_seconds", "CPU time spent compressing."),
+        ):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for encoding, stats in sorted(compression.items()):
+                lines.append('%s{encoding="%s"} %s' % (name, encoding, stats[key]))
+
+        return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+def write_histograms(lines, name, help_text, histograms, buckets):
+    lines.append("# HELP %s %s" % (name, help_text))
+    lines.append("# TYPE %s histogram" % name)
+    for endpoint, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(buckets, histogram.counts):
+            cumulative += count
+            lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, cumulative))
+        lines.append('%s_bucket{endpoint="%s",le="+Inf"} %d' % (name, endpoint, histogram.count))
+        lines.append('%s_sum{endpoint="%s"} %.6f' % (name, endpoint, histogram.sum))
+        lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+
+metrics = Metrics()
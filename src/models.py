@@ -1,6 +1,40 @@
+import math
+import re
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select, update, insert, func, bindparam
+from sqlalchemy.orm import Session, selectinload, load_only, validates
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+def serialize_fields(instance, fields):
+    # only touch the requested columns, the others were not loaded (load_only)
+    return {field: getattr(instance, field) for field in fields}
+
+def fields_options(model, fields):
+    if fields is None:
+        return []
+    return [load_only(*[getattr(model, field) for field in fields])]
+
+NUMBER = re.compile(r"[-+]?\d+(?:\.\d+)?(?:e[-+]?\d+)?")
+
+def parse_number(value):
+    # "200000" -> 200000.0, "1,000" -> 1000.0, "1 standard" -> 1.0, "unknown" / "n/a" -> None
+    if value is None:
+        return None
+    match = NUMBER.match(str(value).strip().lower().replace(",", ""))
+    if match is None:
+        return None
+    number = float(match.group())
+    return number if math.isfinite(number) else None
+
+def numeric_values(model, values):
+    # the numeric shadow columns of a row, for the Core INSERT / UPDATE that skip @validates
+    return {shadow: parse_number(values[field]) for field, shadow in model.NUMERIC_FIELDS.items() if field in values}
+
+# tables whose writes bump their row in table_version (used for the ETags)
+VERSIONED_TABLES = ("user", "planets", "people", "vehicles", "favorite")
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -12,28 +46,75 @@ class User(db.Model):
     def __repr__(self):
         return '<User %r>' % self.email
 
-    def serialize(self):
-        return {
-            "id": self.id,
-            "email": self.email,
-            "is_active": self.is_active,
-            "favoritos": [favorite.serialize() for favorite in self.favoritos]
-            # do not serialize the password, it's a security breach
-        }
+    # columns a client may ask for with ?fields=, the password is never one of them
+    PUBLIC_FIELDS = ("id", "email", "is_active")
+    INCLUDES = ("favorites", "favorites.planet", "favorites.people", "favorites.vehicle")
+
+    @staticmethod
+    def include_options(include):
+        # load every requested relationship with one SELECT ... IN per level,
+        # so the number of queries does not grow with the number of users
+        options = []
+        if "favorites" in include:
+            options.append(selectinload(User.favoritos))
+            for relation in FAVORITE_KINDS:
+                if "favorites." + relation in include:
+                    options.append(selectinload(User.favoritos).selectinload(getattr(Favorite, relation)))
+        return options
+
+    def serialize(self, include=("favorites",), fields=None):
+        if fields is not None:
+            data = serialize_fields(self, fields)
+        else:
+            data = {
+                "id": self.id,
+                "email": self.email,
+                "is_active": self.is_active,
+                # do not serialize the password, it's a security breach
+            }
+        if "favorites" in include:
+            data["favoritos"] = [favorite.serialize(include) for favorite in self.favoritos]
+        return data
 
 class Planets(db.Model):
+    REQUIRED_FIELDS = ("name", "gravity", "population", "terrain")
+    PUBLIC_FIELDS = ("id",) + REQUIRED_FIELDS
+    # text column -> parsed copy used to filter and sort (?population_gte=, ?population_gte=0&sort=-population)
+    NUMERIC_FIELDS = {"gravity": "gravity_num", "population": "population_num"}
+    # ?terrain=desert&terrain=jungle, each one has an index (column, id) below
+    FILTER_FIELDS = ("terrain", "id_people")
+    __table_args__ = (
+        db.Index("ix_planets_terrain", "terrain", "id"),
+        db.Index("ix_planets_id_people", "id_people", "id"),
+        # (numeric copy, id) serves the range filters and the order of ?sort= with them
+        db.Index("ix_planets_gravity_num", "gravity_num", "id"),
+        db.Index("ix_planets_population_num", "population_num", "id"),
+        # /leaderboard reads it backwards: the most favorited first
+        db.Index("ix_planets_favorite_count", "favorite_count", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     gravity = db.Column(db.String(5), nullable=False)
     population = db.Column(db.String(10), nullable=False)
     terrain = db.Column(db.String(20), nullable=False)
+    gravity_num = db.Column(db.Float, nullable=True)
+    population_num = db.Column(db.Float, nullable=True)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     id_people = db.Column(db.Integer, db.ForeignKey("people.id"), nullable=True)
     favoritos = db.relationship('Favorite', back_populates='planet')
 
     def __repr__(self):
         return '<Planet %r>' % self.name
 
-    def serialize(self):
+    @validates("gravity", "population")
+    def update_numeric(self, key, value):
+        setattr(self, self.NUMERIC_FIELDS[key], parse_number(value))
+        return value
+
+    def serialize(self, fields=None):
+        if fields is not None:
+            return serialize_fields(self, fields)
         return {
             "id": self.id,
             "name": self.name,
@@ -43,11 +124,24 @@ class Planets(db.Model):
         }
 
 class People(db.Model):
+    REQUIRED_FIELDS = ("name", "gender", "birth_year", "mass")
+    PUBLIC_FIELDS = ("id",) + REQUIRED_FIELDS
+    NUMERIC_FIELDS = {"mass": "mass_num"}
+    FILTER_FIELDS = ("gender",)
+    __table_args__ = (
+        db.Index("ix_people_gender", "gender", "id"),
+        db.Index("ix_people_mass_num", "mass_num", "id"),
+        # /leaderboard reads it backwards: the most favorited first
+        db.Index("ix_people_favorite_count", "favorite_count", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     gender = db.Column(db.String(25), nullable=False)
     birth_year = db.Column(db.String(20), nullable=False)
     mass = db.Column(db.String(4), nullable=False)
+    mass_num = db.Column(db.Float, nullable=True)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     vehicles = db.relationship("Vehicles", backref="piloto")
     planets = db.relationship("Planets", backref="planeta_origen")
     favoritos = db.relationship("Favorite", back_populates='people')
@@ -55,7 +149,14 @@ class People(db.Model):
     def __repr__(self):
         return '<People %r>' % self.name
 
-    def serialize(self):
+    @validates("mass")
+    def update_numeric(self, key, value):
+        setattr(self, self.NUMERIC_FIELDS[key], parse_number(value))
+        return value
+
+    def serialize(self, fields=None):
+        if fields is not None:
+            return serialize_fields(self, fields)
         return {
             "id": self.id,
             "name": self.name,
@@ -65,18 +166,40 @@ class People(db.Model):
         }
 
 class Vehicles(db.Model):
+    REQUIRED_FIELDS = ("name", "model", "manufacturer", "cost_in_credits")
+    PUBLIC_FIELDS = ("id",) + REQUIRED_FIELDS
+    NUMERIC_FIELDS = {"cost_in_credits": "cost_in_credits_num"}
+    FILTER_FIELDS = ("manufacturer", "model", "people_id")
+    __table_args__ = (
+        db.Index("ix_vehicles_manufacturer", "manufacturer", "id"),
+        db.Index("ix_vehicles_model", "model", "id"),
+        db.Index("ix_vehicles_people_id", "people_id", "id"),
+        db.Index("ix_vehicles_cost_in_credits_num", "cost_in_credits_num", "id"),
+        # /leaderboard reads it backwards: the most favorited first
+        db.Index("ix_vehicles_favorite_count", "favorite_count", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
     model = db.Column(db.String(30), nullable=False)
     manufacturer = db.Column(db.String(50), nullable=False)
     cost_in_credits = db.Column(db.String(15), nullable=False)
+    cost_in_credits_num = db.Column(db.Float, nullable=True)
+    favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     people_id = db.Column(db.Integer, db.ForeignKey("people.id"), nullable=True)
     favoritos = db.relationship('Favorite', back_populates='vehicle')
 
     def __repr__(self):
         return '<Vehicles %r>' % self.name
 
-    def serialize(self):
+    @validates("cost_in_credits")
+    def update_numeric(self, key, value):
+        setattr(self, self.NUMERIC_FIELDS[key], parse_number(value))
+        return value
+
+    def serialize(self, fields=None):
+        if fields is not None:
+            return serialize_fields(self, fields)
         return {
             "id": self.id,
             "name": self.name,
@@ -86,6 +209,14 @@ class Vehicles(db.Model):
         }
 
 class Favorite(db.Model):
+    # one unique index per favorite type: it serves the (user_id, x_id) lookups and also
+    # blocks duplicated favorites (NULLs are distinct, so each row only counts in its own index)
+    __table_args__ = (
+        db.Index("ix_favorite_user_planet", "user_id", "planet_id", unique=True),
+        db.Index("ix_favorite_user_people", "user_id", "people_id", unique=True),
+        db.Index("ix_favorite_user_vehicle", "user_id", "vehicle_id", unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     people_id = db.Column(db.Integer, db.ForeignKey('people.id'), nullable=True)
@@ -100,11 +231,95 @@ class Favorite(db.Model):
     def __repr__(self):
         return '<Favorite %r>' % self.id
 
-    def serialize(self):
-        return {
+    def serialize(self, include=()):
+        data = {
             "id": self.id,
             "user_id": self.user_id,
             "people_id": self.people_id,
             "planet_id": self.planet_id,
             "vehicle_id": self.vehicle_id
-        }
\ No newline at end of file
+        }
+        for relation in FAVORITE_KINDS:
+            if "favorites." + relation in include:
+                related = getattr(self, relation)
+                data[relation] = related.serialize() if related is not None else None
+        return data
+
+class TableVersion(db.Model):
+    __tablename__ = "table_version"
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TableVersion %r %r>' % (self.name, self.version)
+
+def get_table_version(name):
+    # read once per request: the ETag and the cache key of the response use the same number
+    versions = g.setdefault("table_versions", {}) if has_request_context() else {}
+    if name not in versions:
+        versions[name] = db.session.execute(select(TableVersion.version).where(TableVersion.name == name)).scalar() or 0
+    return versions[name]
+
+# the kinds of favorite, the only place that maps them: relation of Favorite (also ?type=
+# of /leaderboard and ?<relation>_fields=) -> (key of /favorite/batch, column of Favorite,
+# model whose favorite_count it feeds)
+FAVORITE_KINDS = {
+    "planet": ("planets", "planet_id", Planets),
+    "people": ("people", "people_id", People),
+    "vehicle": ("vehicles", "vehicle_id", Vehicles),
+}
+
+def change_favorite_counts(connection, model, ids, delta):
+    # same transaction as the favorite rows, the database does the addition so
+    # concurrent requests do not lose updates
+    ids = sorted(ids)
+    for start in range(0, len(ids), 500):
+        connection.execute(
+            update(model.__table__)
+            .where(model.id.in_(ids[start:start + 500]))
+            .values(favorite_count=model.favorite_count + delta)
+        )
+
+def rebuild_favorite_counts(connection):
+    # recounts every favorite_count from the favorite table and only rewrites the rows
+    # that drifted; returns how many rows were fixed in each table
+    fixed = {}
+    for _, column, model in FAVORITE_KINDS.values():
+        target = getattr(Favorite, column)
+        counts = dict(connection.execute(select(target, func.count()).where(target.isnot(None)).group_by(target)).all())
+        stored = dict(connection.execute(select(model.id, model.favorite_count).where(model.favorite_count != 0)).all())
+        changes = [
+            {"_id": item_id, "_count": counts.get(item_id, 0)}
+            for item_id in set(counts) | set(stored) if counts.get(item_id, 0) != stored.get(item_id, 0)
+        ]
+        if changes:
+            connection.execute(
+                update(model.__table__).where(model.id == bindparam("_id")).values(favorite_count=bindparam("_count")),
+                changes
+            )
+        fixed[model.__tablename__] = len(changes)
+    return fixed
+
+def bump_versions(connection, tables):
+    # writes that skip the ORM (bulk inserts, UPDATE ... RETURNING) have to call this themselves
+    if has_request_context():
+        g.pop("table_versions", None)
+    for name in sorted(set(tables)):
+        result = connection.execute(
+            update(TableVersion.__table__)
+            .where(TableVersion.name == name)
+            .values(version=TableVersion.version + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(TableVersion.__table__).values(name=name, version=1))
+
+@event.listens_for(Session, "after_flush")
+def bump_flushed_versions(session, flush_context):
+    # ORM writes (API handlers and Flask-Admin) bump the counter in the same transaction
+    tables = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(instance, "__tablename__", None)
+        if table in VERSIONED_TABLES:
+            tables.add(table)
+    if tables:
+        bump_versions(session.connection(), tables)
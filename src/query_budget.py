@@ -0,0 +1,55 @@
+"""
+Maximum number of SQL statements each endpoint may run, to catch N+1 regressions.
+
+The budget comes from the @query_budget(n) decorator of the view or from the
+QUERY_BUDGETS config map ({"api.obtener_usuario": 4}), which wins over the decorator.
+The statements are counted by the metrics hooks, so METRICS_ENABLED must be on.
+Over budget: a warning in the log, or QueryBudgetExceeded when QUERY_BUDGET_STRICT
+is on (it defaults to app.testing). SQL run while a streamed body is sent is not counted.
+tests/test_query_budget.py runs every route at two data sizes and also fails when the
+number of statements grows with the rows.
+"""
+from flask import current_app, g, request
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def query_budget(limit):
+    # keep it right under the route decorator, so the attribute is on the registered view
+    def decorator(view):
+        view.query_budget = limit
+        return view
+    return decorator
+
+class QueryBudget:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("QUERY_BUDGETS", {})
+        app.config.setdefault("QUERY_BUDGET_STRICT", app.testing)
+        app.after_request(self._check)
+
+    def budget_for(self, endpoint):
+        budgets = current_app.config["QUERY_BUDGETS"]
+        if endpoint in budgets:
+            return budgets[endpoint]
+        view = current_app.view_functions.get(endpoint)
+        return getattr(view, "query_budget", None)
+
+    def _check(self, response):
+        if request.endpoint is None or "sql_statements" not in g:
+            return response
+
+        budget = self.budget_for(request.endpoint)
+        if budget is None or g.sql_statements <= budget:
+            return response
+
+        message = "%s ran %d SQL statements, its budget is %d" % (request.endpoint, g.sql_statements, budget)
+        if current_app.config["QUERY_BUDGET_STRICT"]:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+        return response
+
+budget = QueryBudget()
@@ -0,0 +1,154 @@
+"""
+Read replicas: the GET handlers of the API read from them, everything else from the primary.
+
+DATABASE_REPLICA_URL takes one URL or several separated by commas. Every request picks
+one replica (round robin over the healthy ones) and keeps it until the end, so all its
+reads see the same state. A replica that fails to connect or drops the connection is
+skipped for DB_REPLICA_RETRY_SECONDS, and a request that could not connect to it tries
+the next one; with no healthy replica the reads go to the primary.
+
+Writes never go to a replica, and once a request has written (a flush, an INSERT/UPDATE/
+DELETE or a SELECT ... FOR UPDATE) the rest of its reads go to the primary too. Requests
+after that one can still hit a replica that is behind, as much as the replication lag.
+
+Locally two SQLite files are enough: copy the primary to the replica
+(sqlite3 /tmp/test.db ".backup /tmp/replica.db") and start the API with
+DATABASE_REPLICA_URL=sqlite:////tmp/replica.db.
+"""
+import itertools
+import threading
+import time
+from flask import current_app, g, request, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from database import engine_options_from_env, configure_sqlite, pool_stats
+
+READ_METHODS = ("GET", "HEAD")
+
+def replica_urls(value):
+    return [url.strip().replace("postgres://", "postgresql://") for url in (value or "").split(",") if url.strip()]
+
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.reads = 0
+        self.failures = 0
+        self.down_until = 0.0
+
+    def to_dict(self, now):
+        return {
+            "url": self.engine.url.render_as_string(hide_password=True),
+            "healthy": self.down_until <= now,
+            "requests": self.reads,
+            "failures": self.failures,
+            "pool": self.engine.pool.status(),
+            "checkouts": pool_stats(self.engine),
+        }
+
+class ReplicaSet:
+    # the replicas of one app, in app.extensions["replicas"]
+    def __init__(self, urls, retry_seconds):
+        self.retry_seconds = retry_seconds
+        self.replicas = []
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        for url in urls:
+            # create_engine does not connect, the app can still be built before the fork
+            engine = create_engine(url, **engine_options_from_env(url))
+            if engine.dialect.name == "sqlite":
+                configure_sqlite(engine)
+            replica = Replica(engine)
+            event.listen(engine, "handle_error", lambda context, replica=replica: self._failed(replica, context))
+            self.replicas.append(replica)
+
+    @property
+    def engines(self):
+        return [replica.engine for replica in self.replicas]
+
+    def choose(self):
+        now = time.monotonic()
+        healthy = [replica for replica in self.replicas if replica.down_until <= now]
+        if not healthy:
+            return None
+        replica = healthy[next(self._next) % len(healthy)]
+        with self._lock:
+            replica.reads += 1
+        return replica.engine
+
+    def _failed(self, replica, context):
+        # only the errors of the server or the connection, not a bad query
+        if not context.is_disconnect and not isinstance(context.sqlalchemy_exception, OperationalError):
+            return
+        with self._lock:
+            replica.failures += 1
+            replica.down_until = time.monotonic() + self.retry_seconds
+
+    def to_dict(self):
+        now = time.monotonic()
+        with self._lock:
+            return [replica.to_dict(now) for replica in self.replicas]
+
+NO_REPLICAS = ReplicaSet([], 0)
+
+class Replicas:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("SQLALCHEMY_REPLICA_URIS", [])
+        app.config.setdefault("REPLICA_RETRY_SECONDS", 30)
+        app.extensions["replicas"] = ReplicaSet(app.config["SQLALCHEMY_REPLICA_URIS"], app.config["REPLICA_RETRY_SECONDS"])
+
+    @property
+    def current(self):
+        return current_app.extensions.get("replicas", NO_REPLICAS)
+
+    @property
+    def engines(self):
+        return self.current.engines
+
+    def to_dict(self):
+        return self.current.to_dict()
+
+replicas = Replicas()
+
+def is_write(clause):
+    return clause is not None and (getattr(clause, "is_dml", False) or getattr(clause, "_for_update_arg", None) is not None)
+
+class RoutingSession(Session):
+    # db.session of Flask-SQLAlchemy, with the reads of the API GET handlers sent to a replica
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and replicas.current.replicas:
+            engine = self._replica_for(clause)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _replica_for(self, clause):
+        # Flask-Admin redirects to its list after saving, it has to read from the primary
+        if request.method not in READ_METHODS or request.blueprint != "api":
+            return None
+        if self._flushing or is_write(clause):
+            g.db_wrote = True
+        if g.get("db_wrote"):
+            return None
+        if "db_replica" not in g:
+            g.db_replica = self._connect_replica()
+        return g.db_replica
+
+    def _connect_replica(self):
+        # connecting now lets the request move on to the next replica (or the primary)
+        # when the chosen one does not answer; handle_error has already marked it down
+        replica_set = replicas.current
+        for _ in replica_set.replicas:
+            engine = replica_set.choose()
+            if engine is None:
+                break
+            try:
+                self.connection(bind_arguments={"bind": engine})
+            except OperationalError:
+                continue
+            return engine
+        return None
@@ -0,0 +1,94 @@
+"""
+Name search over people, planets and vehicles for GET /search?q=.
+
+Each word of the query is matched as a prefix ("tat oo" finds "Tatooine Ooloo") and
+the results are ranked, names weigh more than terrain, manufacturer and model.
+The index depends on the database, it is created by the migrations:
+
+- SQLite: the FTS5 table search_index, filled by triggers on the three tables. Its
+  rowid is id * 4 + the type code, so a row is found and replaced without a scan.
+- PostgreSQL: GIN indexes on the to_tsvector expressions below, the database keeps
+  them up to date by itself.
+- Anything else, or a SQLite database created without migrations: name LIKE 'q%'.
+"""
+import re
+from sqlalchemy import select, literal, text, union_all, case, func
+from models import People, Planets, Vehicles
+
+SEARCH_TYPES = {"people": People, "planets": Planets, "vehicles": Vehicles}
+
+# type code of the rows of the SQLite index (rowid % 4)
+SEARCH_TYPE_CODES = {"people": 1, "planets": 2, "vehicles": 3}
+
+# they must stay equal to the expressions of the indexes created by the migration
+POSTGRES_DOCUMENTS = {
+    "people": "setweight(to_tsvector('simple', name), 'A')",
+    "planets": "setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', coalesce(terrain, '')), 'B')",
+    "vehicles": "setweight(to_tsvector('simple', name), 'A') || setweight(to_tsvector('simple', coalesce(manufacturer, '') || ' ' || coalesce(model, '')), 'B')",
+}
+
+_sqlite_index = {}
+
+def search_terms(q):
+    # only words reach the index syntax, quotes and operators of the user are dropped
+    return re.findall(r"\w+", q or "")[:10]
+
+def has_sqlite_index(connection):
+    # looked up once per engine
+    engine = connection.engine
+    if engine not in _sqlite_index:
+        _sqlite_index[engine] = connection.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")
+        ).first() is not None
+    return _sqlite_index[engine]
+
+def search(session, q, types, limit, offset):
+    # returns one page of {"type", "id", "name"} and whether there are more results
+    terms = search_terms(q)
+    connection = session.connection()
+    dialect = connection.dialect.name
+    if dialect == "sqlite" and has_sqlite_index(connection):
+        rows = search_sqlite(session, terms, types, limit + 1, offset)
+    elif dialect == "postgresql":
+        rows = search_postgres(session, terms, types, limit + 1, offset)
+    else:
+        rows = search_like(session, " ".join(terms), types, limit + 1, offset)
+
+    items = [{"type": row[0], "id": row[1], "name": row[2]} for row in rows[:limit]]
+    return items, len(rows) > limit
+
+def search_sqlite(session, terms, types, limit, offset):
+    names = {code: name for name, code in SEARCH_TYPE_CODES.items()}
+    codes = ", ".join(str(SEARCH_TYPE_CODES[name]) for name in types)
+    rows = session.execute(text(
+        "SELECT rowid % 4 AS code, rowid / 4 AS id, name FROM search_index "
+        "WHERE search_index MATCH :match AND rowid % 4 IN (" + codes + ") "
+        "ORDER BY bm25(search_index, 10.0, 1.0), rowid LIMIT :limit OFFSET :offset"
+    ), {"match": " ".join('"%s"*' % term for term in terms), "limit": limit, "offset": offset}).all()
+    return [(names[row.code], row.id, row.name) for row in rows]
+
+def search_postgres(session, terms, types, limit, offset):
+    query = " & ".join("%s:*" % term for term in terms)
+    selects = [
+        "SELECT '%s' AS type, id, name, ts_rank(%s, query) AS rank FROM %s, to_tsquery('simple', :query) query "
+        "WHERE %s @@ query" % (name, POSTGRES_DOCUMENTS[name], SEARCH_TYPES[name].__tablename__, POSTGRES_DOCUMENTS[name])
+        for name in types
+    ]
+    return session.execute(text(
+        " UNION ALL ".join(selects) + " ORDER BY rank DESC, type, id LIMIT :limit OFFSET :offset"
+    ), {"query": query, "limit": limit, "offset": offset}).all()
+
+def search_like(session, q, types, limit, offset):
+    prefix = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    selects = [
+        select(
+            literal(name).label("type"), model.id.label("id"), model.name.label("name"),
+            # the exact name first, then the names that start with q
+            case((func.lower(model.name) == q.lower(), 0), else_=1).label("rank"),
+        ).where(model.name.like(prefix, escape="\\"))
+        for name, model in SEARCH_TYPES.items() if name in types
+    ]
+    stmt = union_all(*selects).subquery()
+    return session.execute(
+        select(stmt.c.type, stmt.c.id, stmt.c.name).order_by(stmt.c.rank, stmt.c.name, stmt.c.type, stmt.c.id).limit(limit).offset(offset)
+    ).all()
@@ -1,4 +1,18 @@
-from flask import jsonify, url_for
+import base64
+import json
+import math
+import operator
+from sqlalchemy import select, and_, or_
+from flask import jsonify, url_for, current_app, request, Response, stream_with_context
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+NDJSON_MIMETYPE = "application/x-ndjson"
+MAX_FILTER_VALUES = 100
+# query parameters every list endpoint understands, besides its filters
+LIST_PARAMS = {"limit", "after", "fields", "stream", "sort"}
+RANGE_OPERATORS = {"gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
 
 class APIException(Exception):
     status_code = 400
@@ -15,13 +29,260 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def encode_cursor(value):
+    # the cursor is opaque for the clients, it only carries the last key they have seen
+    raw = json.dumps(value, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (ValueError, TypeError):
+        raise APIException("Cursor inválido", status_code=400)
+
+def get_page_params(args, sort_keys=0):
+    default_size = current_app.config.get("API_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    max_size = current_app.config.get("API_MAX_PAGE_SIZE", MAX_PAGE_SIZE)
+
+    limit = args.get("limit", default_size)
+    try:
+        limit = int(limit)
+    except (ValueError, TypeError):
+        raise APIException("limit debe ser un número entero", status_code=400)
+    if limit < 1:
+        raise APIException("limit debe ser mayor que 0", status_code=400)
+
+    after = args.get("after")
+    if after is not None:
+        after = decode_cursor(after)
+        if sort_keys:
+            # [value of every sort key..., id]
+            valid = (isinstance(after, list) and len(after) == sort_keys + 1 and isinstance(after[-1], int)
+                     and all(isinstance(value, (int, float, str)) for value in after[:-1]))
+        else:
+            valid = isinstance(after, int)
+        if not valid:
+            raise APIException("Cursor inválido", status_code=400)
+
+    # the server always has the last word about the page size
+    return min(limit, max_size), after
+
+def get_include_params(args, allowed, default=()):
+    # ?include=favorites,favorites.planet ; an empty value means "include nothing"
+    value = args.get("include")
+    if value is None:
+        return set(default)
+
+    include = set(item.strip() for item in value.split(",") if item.strip())
+    unknown = include - set(allowed)
+    if unknown:
+        raise APIException("include no permitido: " + ", ".join(sorted(unknown)), status_code=400)
+
+    # a nested expansion needs its parent to be loaded too
+    for item in list(include):
+        if "." in item:
+            include.add(item.split(".")[0])
+    return include
+
+def get_fields_params(args, allowed, name="fields"):
+    # ?fields=id,name ; None means every public field
+    value = args.get(name)
+    if value is None:
+        return None
+
+    fields = [field.strip() for field in value.split(",") if field.strip()]
+    if not fields:
+        raise APIException("%s no puede estar vacío" % name, status_code=400)
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise APIException("%s no permitidos: %s" % (name, ", ".join(unknown)), status_code=400)
+    return tuple(dict.fromkeys(fields))
+
+def get_filter_params(args, model):
+    # ?gender=male&terrain=desert&terrain=jungle&population_gte=1000000&sort=-population,gender
+    # returns the WHERE conditions and the sort keys as (column, descending),
+    # the id is always the last key of the order
+    ranges = {field + "_" + suffix: (shadow, compare) for field, shadow in model.NUMERIC_FIELDS.items()
+              for suffix, compare in RANGE_OPERATORS.items()}
+    # anything else could only be served by a full scan
+    unknown = set(args) - LIST_PARAMS - set(model.FILTER_FIELDS) - set(ranges)
+    if unknown:
+        raise APIException("Parámetros no permitidos: " + ", ".join(sorted(unknown)), status_code=400)
+
+    where = []
+    filtered = set()
+    for field in model.FILTER_FIELDS:
+        # a repeated parameter is an IN
+        values = args.getlist(field)
+        if not values:
+            continue
+        if len(values) > MAX_FILTER_VALUES:
+            raise APIException("Máximo %d valores para %s" % (MAX_FILTER_VALUES, field), status_code=400)
+        column = getattr(model, field)
+        if column.type.python_type is int:
+            try:
+                values = [int(value) for value in values]
+            except ValueError:
+                raise APIException("%s debe ser un número entero" % field, status_code=400)
+        where.append(column == values[0] if len(values) == 1 else column.in_(values))
+        filtered.add(field)
+
+    for name, (shadow, compare) in ranges.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        try:
+            number = float(value)
+        except ValueError:
+            number = math.nan
+        if not math.isfinite(number):
+            raise APIException("%s debe ser un número" % name, status_code=400)
+        where.append(compare(getattr(model, shadow), number))
+        filtered.add(shadow)
+
+    sort = []
+    value = args.get("sort")
+    for item in (value.split(",") if value else ()):
+        item = item.strip()
+        field = item.lstrip("-")
+        if field not in model.NUMERIC_FIELDS and field not in model.FILTER_FIELDS:
+            raise APIException("sort no permitido: " + item, status_code=400)
+        key = model.NUMERIC_FIELDS.get(field, field)
+        column = getattr(model, key)
+        # ordering a nullable column puts its NULLs somewhere no index has them, every page
+        # would sort the whole table; a filter on the column leaves the NULLs out
+        if column.expression.nullable and key not in filtered:
+            raise APIException("sort por %s necesita también un filtro sobre %s" % (field, field), status_code=400)
+        if key not in [column.key for column, _ in sort]:
+            sort.append((column, item.startswith("-")))
+    return where, sort
+
+def keyset_order(model, sort):
+    order = []
+    for column, descending in sort:
+        order.append(column.desc() if descending else column)
+    # the id goes the way of the last key, so a (column, id) index read backwards serves -column
+    return order + [model.id.desc() if sort and sort[-1][1] else model.id]
+
+def keyset_condition(model, sort, after):
+    # rows after the cursor in keyset_order: (a > x) OR (a = x AND b > y) OR ... OR (all equal AND id > z),
+    # with < for the descending keys and for the id after a descending last key
+    if not sort:
+        return model.id > after
+    alternatives = []
+    equal = []
+    for (column, descending), value in zip(sort, after[:-1]):
+        later = column < value if descending else column > value
+        alternatives.append(and_(*equal, later))
+        equal.append(column == value)
+    last = model.id < after[-1] if sort[-1][1] else model.id > after[-1]
+    alternatives.append(and_(*equal, last))
+    return or_(*alternatives)
+
+def keyset_page(query, column, limit, after=None):
+    # WHERE id > :after ORDER BY id LIMIT :limit + 1, deep pages cost the same as the first one
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+def paginated_response(items, next_cursor, status_code=200):
+    response = jsonify(items)
+    response.status_code = status_code
+    response.vary.add("Accept")
+    if next_cursor is not None:
+        # flat=False keeps the repeated parameters (?terrain=desert&terrain=jungle)
+        args = request.args.to_dict(flat=False)
+        # the path variables win over a query parameter with the same name (?user_id=)
+        for name in request.view_args or ():
+            args.pop(name, None)
+        args["after"] = next_cursor
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = '<%s>; rel="next"' % url_for(request.endpoint, **request.view_args, **args)
+    return response
+
+def chunked(items, size=500):
+    # keeps the IN (...) lists under the bind parameter limit of the driver
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def wants_stream():
+    # ?stream=1 or "Accept: application/x-ndjson"
+    if request.args.get("stream") in ("1", "true"):
+        return True
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def ndjson_response(rows, serialize=None, batch_size=STREAM_BATCH_SIZE):
+    # rows is a lazy iterable (yield_per / stream_results), every batch is written
+    # to the client as it arrives, so memory does not grow with the table
+    def generate():
+        lines = []
+        for row in rows:
+            item = serialize(row) if serialize is not None else row
+            lines.append(current_app.json.dumps(item, separators=(",", ":")))
+            if len(lines) >= batch_size:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+    response.vary.add("Accept")
+    return response
+
+def stream_after(query, column, after=None):
+    if after is not None:
+        query = query.filter(column > after)
+    return query.order_by(column).yield_per(STREAM_BATCH_SIZE)
+
+def columns_select(model, fields=None, after=None, where=(), sort=()):
+    # Core SELECT of exactly the serialized columns: no mapped instances, no identity map
+    fields = fields or model.PUBLIC_FIELDS
+    columns = [getattr(model, field) for field in fields]
+    # the keys of the cursor are selected too, they are not part of the output
+    if "id" not in fields:
+        columns.append(model.id)
+    columns += [column.label("sort_%d" % index) for index, (column, _) in enumerate(sort)]
+    stmt = select(*columns).where(*where)
+    if after is not None:
+        stmt = stmt.where(keyset_condition(model, sort, after))
+    return stmt.order_by(*keyset_order(model, sort)), fields
+
+def keyset_rows(session, model, fields, limit, after=None, where=(), sort=()):
+    stmt, fields = columns_select(model, fields, after, where, sort)
+    rows = session.execute(stmt.limit(limit + 1)).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        if sort:
+            next_cursor = encode_cursor([getattr(last, "sort_%d" % index) for index in range(len(sort))] + [last.id])
+        else:
+            next_cursor = encode_cursor(last.id)
+    return [dict(zip(fields, row)) for row in rows], next_cursor
+
+def stream_rows(session, model, fields=None, after=None, where=(), sort=(), batch_size=STREAM_BATCH_SIZE):
+    stmt, fields = columns_select(model, fields, after, where, sort)
+    result = session.execute(stmt.execution_options(stream_results=True))
+    for partition in result.partitions(batch_size):
+        for row in partition:
+            yield dict(zip(fields, row))
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = ['/admin/'] if 'admin' in app.blueprints else []
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
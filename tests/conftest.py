@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import insert
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from seed import create_bench_app, seed
+from models import db, People, Planets, Vehicles, Favorite, bump_versions, rebuild_favorite_counts
+
+# the same routes must run the same number of statements on both
+DATA_SIZES = {
+    "small": {"people": 20, "planets": 20, "vehicles": 20, "users": 5, "favorites": 30},
+    "large": {"people": 400, "planets": 400, "vehicles": 400, "users": 50, "favorites": 1500},
+}
+
+def add_related_rows():
+    # rows that every size has in the same shape, for the routes whose cost depends on
+    # the relations of one row (deleting a person with a vehicle, a planet and favorites)
+    ids = {}
+    ids["person"] = db.session.execute(insert(People).values(
+        name="Budget person", gender="n/a", birth_year="19BBY", mass="77", mass_num=77,
+    )).inserted_primary_key[0]
+    ids["person_planet"] = db.session.execute(insert(Planets).values(
+        name="Budget person planet", gravity="1", population="1", terrain="desert",
+        gravity_num=1, population_num=1, id_people=ids["person"],
+    )).inserted_primary_key[0]
+    ids["person_vehicle"] = db.session.execute(insert(Vehicles).values(
+        name="Budget person vehicle", model="AT-AT", manufacturer="Kuat Drive Yards",
+        cost_in_credits="1000", cost_in_credits_num=1000, people_id=ids["person"],
+    )).inserted_primary_key[0]
+    ids["planet"] = db.session.execute(insert(Planets).values(
+        name="Budget planet", gravity="1", population="1", terrain="desert", gravity_num=1, population_num=1,
+    )).inserted_primary_key[0]
+    ids["vehicle"] = db.session.execute(insert(Vehicles).values(
+        name="Budget vehicle", model="AT-AT", manufacturer="Kuat Drive Yards", cost_in_credits="1000", cost_in_credits_num=1000,
+    )).inserted_primary_key[0]
+    ids["user"] = 2
+    db.session.execute(insert(Favorite), [
+        {"user_id": 1, "people_id": ids["person"], "planet_id": None, "vehicle_id": None},
+        {"user_id": 1, "people_id": None, "planet_id": ids["planet"], "vehicle_id": None},
+        {"user_id": 1, "people_id": None, "planet_id": None, "vehicle_id": ids["vehicle"]},
+    ])
+    rebuild_favorite_counts(db.session.connection())
+    bump_versions(db.session.connection(), ["people", "planets", "vehicles", "favorite"])
+    db.session.commit()
+    return ids
+
+def create_seeded_app(path, size):
+    # QUERY_BUDGET_STRICT follows TESTING: a request over its budget raises
+    app = create_bench_app("sqlite:///%s" % path, TESTING=True, CACHE_ENABLED=False)
+    with app.app_context():
+        seed(db, **DATA_SIZES[size])
+        app.config["SEEDED_IDS"] = add_related_rows()
+        db.session.remove()
+    return app
+
+@pytest.fixture(scope="session")
+def seeded_apps(tmp_path_factory):
+    # one app per data size, each on its own SQLite file
+    apps = {size: create_seeded_app(tmp_path_factory.mktemp(size) / "test.db", size) for size in DATA_SIZES}
+    yield apps
+    for app in apps.values():
+        with app.app_context():
+            db.engine.dispose()
+
+@pytest.fixture
+def app(seeded_apps):
+    return seeded_apps["small"]
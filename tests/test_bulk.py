@@ -0,0 +1,17 @@
+def test_bulk_rejects_values_that_are_not_scalars(app):
+    client = app.test_client()
+    items = [
+        {"name": "Bulk object", "gravity": {"x": 1}, "population": "1", "terrain": "desert"},
+        {"name": "Bulk list", "gravity": "1", "population": [1], "terrain": "desert"},
+        {"name": "Bulk bool", "gravity": "1", "population": "1", "terrain": True},
+        {"name": "Bulk number", "gravity": 1, "population": 2.5, "terrain": "desert"},
+    ]
+    response = client.post("/planet/bulk?mode=partial", json=items)
+
+    assert response.status_code == 207
+    results = response.get_json()["results"]
+    assert [result["status"] for result in results] == ["error", "error", "error", "created"]
+    assert results[0]["error"] == "gravity deben ser un texto o un número"
+
+    planet = client.get("/planets/%d" % results[3]["id"]).get_json()
+    assert (planet["gravity"], planet["population"]) == ("1", "2.5")
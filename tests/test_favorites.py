@@ -0,0 +1,149 @@
+import pytest
+from sqlalchemy import event, select, delete, update
+from models import db, Favorite, Planets
+
+def query_plan(statement):
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+    return " | ".join(row[-1] for row in db.session.execute(db.text("EXPLAIN QUERY PLAN " + sql)))
+
+@pytest.mark.parametrize("statement, index", [
+    # eliminar_fav_planeta / eliminar_fav_people and the duplicate checks
+    (lambda: Favorite.query.filter_by(user_id=1, planet_id=2).statement, "ix_favorite_user_planet"),
+    (lambda: Favorite.query.filter_by(user_id=1, people_id=2).statement, "ix_favorite_user_people"),
+    (lambda: Favorite.query.filter_by(user_id=1, vehicle_id=2).statement, "ix_favorite_user_vehicle"),
+    # the favorites of a user (User.favoritos, /users/<id>/favorites)
+    (lambda: select(Favorite).where(Favorite.user_id == 1), "ix_favorite_user_"),
+    (lambda: select(Favorite).where(Favorite.user_id.in_([1, 2])), "ix_favorite_user_"),
+])
+def test_favorite_lookups_use_the_indexes(app, statement, index):
+    with app.app_context():
+        plan = query_plan(statement())
+    assert "USING INDEX " + index in plan or "USING COVERING INDEX " + index in plan, plan
+
+def test_duplicated_favorite_is_rejected(app):
+    client = app.test_client()
+    planet_id = app.config["SEEDED_IDS"]["planet"]
+    with app.app_context():
+        if db.session.execute(select(Favorite.id).filter_by(user_id=3, planet_id=planet_id)).first() is None:
+            assert client.post("/favorite/planet/%d" % planet_id, json={"user_id": 3}).status_code == 200
+
+    response = client.post("/favorite/planet/%d" % planet_id, json={"user_id": 3})
+    assert response.status_code == 400
+    assert response.get_json() == {"Error": "El planeta ya es favorito"}
+
+def test_favorite_of_an_unknown_user_is_not_a_duplicate(app):
+    # SQLite only checks foreign keys with the pragma on, as Postgres and MySQL always do
+    def enable_foreign_keys(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA foreign_keys=ON")
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "connect", enable_foreign_keys)
+    engine.dispose()
+    try:
+        client = app.test_client()
+        for path in ("/favorite/planet/1", "/favorite/people/1"):
+            response = client.post(path, json={"user_id": 999999})
+            assert response.status_code == 404, path
+            assert response.get_json() == {"Error": "No se ha encontrado usuario"}
+    finally:
+        event.remove(engine, "connect", enable_foreign_keys)
+        engine.dispose()
+
+@pytest.mark.parametrize("body, error", [
+    ({"user_id": 1, "add": {"planets": [True]}}, "add.planets debe ser una lista de ids"),
+    ({"user_id": 1, "remove": {"people": [1, False]}}, "remove.people debe ser una lista de ids"),
+    ({"user_id": "1", "add": {"planets": [1]}}, "user_id debe ser un número entero"),
+    ({"user_id": True, "add": {"planets": [1]}}, "user_id debe ser un número entero"),
+])
+def test_batch_rejects_ids_that_are_not_integers(app, body, error):
+    response = app.test_client().post("/favorite/batch", json=body)
+    assert response.status_code == 400
+    assert response.get_json()["message"] == error
+
+def test_batch_removal_decrements_only_what_it_deleted(app):
+    from app import borrar_favoritos
+    from models import Vehicles
+
+    client = app.test_client()
+    vehicle_id = app.config["SEEDED_IDS"]["person_vehicle"]
+    with app.app_context():
+        before = db.session.get(Vehicles, vehicle_id).favorite_count
+    assert client.post("/favorite/batch", json={"user_id": 4, "add": {"vehicles": [vehicle_id]}}).get_json()["added"] == 1
+
+    # a concurrent request that already removed it finds nothing left to delete
+    with app.test_request_context(method="POST"):
+        assert borrar_favoritos(4, "vehicle_id", [vehicle_id]) == {vehicle_id}
+        assert borrar_favoritos(4, "vehicle_id", [vehicle_id]) == set()
+        db.session.rollback()
+
+    response = client.post("/favorite/batch", json={"user_id": 4, "remove": {"vehicles": [vehicle_id]}})
+    assert response.get_json()["removed"] == 1
+    with app.app_context():
+        assert db.session.get(Vehicles, vehicle_id).favorite_count == before
+
+@pytest.mark.parametrize("kind, model_name", [("planet", "Planets"), ("people", "People")])
+def test_deleting_a_favorite_twice_decrements_once(app, kind, model_name):
+    import models
+
+    model = getattr(models, model_name)
+    client = app.test_client()
+    item_id = app.config["SEEDED_IDS"]["person" if kind == "people" else "planet"]
+    path = "/favorite/%s/%d" % (kind, item_id)
+    with app.app_context():
+        before = db.session.get(model, item_id).favorite_count
+    assert client.post(path, json={"user_id": 5}).status_code == 200
+
+    assert client.delete(path, json={"user_id": 5}).status_code == 200
+    response = client.delete(path, json={"user_id": 5})
+    assert response.status_code == 404
+    assert response.get_json() == {"Error": "No se ha encontrado favorito"}
+    with app.app_context():
+        assert db.session.get(model, item_id).favorite_count == before
+
+def test_concurrent_delete_of_a_favorite_decrements_once(app):
+    # another request removes the same favorite (and decrements) right after this one
+    # looked it up; with DELETE ... RETURNING there is no lookup and nothing to race
+    client = app.test_client()
+    planet_id = app.config["SEEDED_IDS"]["person_planet"]
+    path = "/favorite/planet/%d" % planet_id
+    with app.app_context():
+        engine = db.engine
+        before = db.session.get(Planets, planet_id).favorite_count
+    assert client.post(path, json={"user_id": 5}).status_code == 200
+
+    raced = []
+    def delete_concurrently(conn, cursor, statement, parameters, context, executemany):
+        if raced or not statement.startswith("SELECT") or "FROM favorite" not in statement:
+            return
+        raced.append(True)
+        with engine.begin() as other:
+            deleted = other.execute(delete(Favorite.__table__).where(Favorite.user_id == 5, Favorite.planet_id == planet_id))
+            if deleted.rowcount:
+                other.execute(update(Planets.__table__).where(Planets.id == planet_id).values(favorite_count=Planets.favorite_count - 1))
+
+    event.listen(engine, "after_cursor_execute", delete_concurrently)
+    try:
+        response = client.delete(path, json={"user_id": 5})
+    finally:
+        event.remove(engine, "after_cursor_execute", delete_concurrently)
+
+    assert response.status_code == (404 if raced else 200)
+    with app.app_context():
+        assert db.session.get(Planets, planet_id).favorite_count == before
+
+def test_next_link_of_user_favorites_ignores_a_user_id_parameter(app):
+    response = app.test_client().get("/users/1/favorites?limit=1&user_id=9")
+
+    assert response.status_code == 200
+    link = response.headers["Link"]
+    assert link.startswith("</users/1/favorites?") and "user_id" not in link, link
+
+def test_batch_rejects_lists_over_the_bulk_limit(app, monkeypatch):
+    monkeypatch.setitem(app.config, "BULK_MAX_ITEMS", 3)
+    client = app.test_client()
+
+    response = client.post("/favorite/batch", json={"user_id": 5, "remove": {"planets": [1, 2, 3, 4]}})
+    assert response.status_code == 400
+    assert response.get_json()["message"] == "Máximo 3 ids en remove.planets"
+    assert client.post("/favorite/batch", json={"user_id": 5, "remove": {"planets": [1, 2, 3]}}).status_code == 200
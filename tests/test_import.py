@@ -0,0 +1,42 @@
+import json
+from sqlalchemy import select
+from models import db, Vehicles
+
+def vehicle(name, **values):
+    return dict({"name": name, "model": "AT-AT", "manufacturer": "Kuat Drive Yards", "cost_in_credits": "1000"}, **values)
+
+def test_import_skips_bad_rows_and_keeps_going(app, tmp_path):
+    lines = [
+        json.dumps(vehicle("Import ok 1", people_id=1)),
+        '{"name": "Import broken", ',
+        json.dumps(vehicle("Import bad people", people_id="abc")),
+        json.dumps(vehicle("Import object", model={"x": 1})),
+        json.dumps(vehicle("Import ok 2", people_id="")),
+    ]
+    path = tmp_path / "vehicles.ndjson"
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+
+    result = app.test_cli_runner().invoke(args=["import", "vehicles", str(path), "--batch-size", "2"])
+
+    assert result.exit_code == 0, result.output
+    assert "línea 2: JSON inválido" in result.output
+    assert "Import bad people: people_id debe ser un número entero" in result.output
+    assert "Import object: model deben ser un texto o un número" in result.output
+    assert "2 filas importadas, 3 omitidas" in result.output
+    with app.app_context():
+        imported = db.session.execute(select(Vehicles.name, Vehicles.people_id).where(Vehicles.name.like("Import %"))).all()
+    assert sorted(imported) == [("Import ok 1", 1), ("Import ok 2", None)]
+
+def test_reimport_without_the_people_link_keeps_it(app, tmp_path):
+    def run_import(items):
+        path = tmp_path / "vehicles.ndjson"
+        path.write_text("\n".join(json.dumps(item) for item in items) + "\n", encoding="utf-8")
+        result = app.test_cli_runner().invoke(args=["import", "vehicles", str(path)])
+        assert result.exit_code == 0, result.output
+
+    run_import([vehicle("Reimport linked", people_id=1), vehicle("Reimport unlinked", people_id=1)])
+    run_import([vehicle("Reimport linked", model="AT-ST"), vehicle("Reimport unlinked", people_id=None)])
+
+    with app.app_context():
+        imported = db.session.execute(select(Vehicles.name, Vehicles.model, Vehicles.people_id).where(Vehicles.name.like("Reimport %"))).all()
+    assert sorted(imported) == [("Reimport linked", "AT-ST", 1), ("Reimport unlinked", "AT-AT", None)]
@@ -0,0 +1,36 @@
+import pytest
+from models import db
+
+@pytest.mark.parametrize("url", [
+    "/planets?sort=-population",
+    "/planets?sort=id_people",
+    "/vehicles?manufacturer=Kuat%20Drive%20Yards&sort=-cost_in_credits",
+])
+def test_sort_on_a_nullable_column_needs_a_filter_on_it(app, url):
+    response = app.test_client().get(url)
+    assert response.status_code == 400
+    assert "necesita también un filtro" in response.get_json()["message"]
+
+def test_filtered_sort_pages_through_the_index(app):
+    from sqlalchemy import text
+    from models import Planets
+    from utils import columns_select, get_filter_params
+    from werkzeug.datastructures import MultiDict
+
+    client = app.test_client()
+    url = "/planets?limit=7&population_gte=0&sort=-population&fields=id,population"
+    seen = []
+    while url:
+        response = client.get(url)
+        assert response.status_code == 200
+        seen += response.get_json()
+        url = response.headers.get("Link", "")[1:].split(">")[0] or None
+    keys = [(-float(planet["population"]), -planet["id"]) for planet in seen]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys)
+
+    with app.test_request_context():
+        where, sort = get_filter_params(MultiDict([("population_gte", "0"), ("sort", "-population")]), Planets)
+        stmt, _ = columns_select(Planets, ("id",), None, where, sort)
+        sql = str(stmt.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+        plan = " | ".join(row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql)))
+    assert "INDEX ix_planets_population_num" in plan and "TEMP B-TREE" not in plan, plan
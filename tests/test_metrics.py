@@ -0,0 +1,23 @@
+import pytest
+from query_budget import QueryBudgetExceeded
+
+def requests_total(client, endpoint, status):
+    series = 'http_requests_total{endpoint="%s",method="GET",status="%d"} ' % (endpoint, status)
+    for line in client.get("/metrics").get_data(as_text=True).splitlines():
+        if line.startswith(series):
+            return int(line[len(series):])
+    return 0
+
+def test_requests_that_raise_are_counted_as_500(app, monkeypatch):
+    client = app.test_client()
+    path = "/planets/%d" % app.config["SEEDED_IDS"]["planet"]
+    ok = requests_total(client, "api.obtener_planeta_id", 200)
+    failed = requests_total(client, "api.obtener_planeta_id", 500)
+
+    assert client.get(path).status_code == 200
+    monkeypatch.setitem(app.config["QUERY_BUDGETS"], "api.obtener_planeta_id", 0)
+    with pytest.raises(QueryBudgetExceeded):
+        client.get(path)
+
+    assert requests_total(client, "api.obtener_planeta_id", 200) == ok + 1
+    assert requests_total(client, "api.obtener_planeta_id", 500) == failed + 1
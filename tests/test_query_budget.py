@@ -0,0 +1,108 @@
+"""
+Every route of the API runs against the seeded database at both data sizes: it has to stay
+within its @query_budget (strict under TESTING, going over raises QueryBudgetExceeded)
+and run the same number of statements on both, or something loads rows one by one.
+"""
+import pytest
+from sqlalchemy import event
+from models import db
+from query_budget import QueryBudgetExceeded
+
+def planet(name):
+    return {"name": name, "gravity": "1", "population": "1000", "terrain": "desert"}
+
+def person(name):
+    return {"name": name, "gender": "n/a", "birth_year": "19BBY", "mass": "77"}
+
+def vehicle(name):
+    return {"name": name, "model": "T-16 skyhopper", "manufacturer": "Incom Corporation", "cost_in_credits": "14500"}
+
+# (endpoint, method, url, body, expected status), run in this order: the deletes go last
+# and remove rows that have related vehicles, planets and favorites
+ROUTES = (
+    ("api.sitemap", "GET", "/", None, 200),
+    ("api.cache_stats", "GET", "/cache/stats", None, 200),
+    ("api.compression_stats", "GET", "/compression/stats", None, 200),
+    ("api.pool_status", "GET", "/pool/stats", None, 200),
+    ("api.obtener_personas", "GET", "/people?limit=10&mass_gte=0&sort=-mass", None, 200),
+    ("api.obtener_persona_id", "GET", "/people/{person}", None, 200),
+    ("api.obtener_planetas", "GET", "/planets?limit=10&terrain=desert", None, 200),
+    ("api.obtener_planeta_id", "GET", "/planets/{planet}", None, 200),
+    ("api.obtener_vehiculos", "GET", "/vehicles?limit=10", None, 200),
+    ("api.buscar", "GET", "/search?q=Budget", None, 200),
+    ("api.ranking_favoritos", "GET", "/leaderboard?type=planet", None, 200),
+    ("api.obtener_usuario", "GET", "/users?limit=10&include=favorites.planet,favorites.people,favorites.vehicle", None, 200),
+    ("api.obtener_favoritos", "GET", "/users/favorites", None, 200),
+    ("api.obtener_favoritos_usuario", "GET", "/users/1/favorites", None, 200),
+    ("api.agregar_planeta", "POST", "/planet", planet("Budget new planet"), 200),
+    ("api.editar_planeta", "PUT", "/planet/{planet}", planet("Budget planet"), 200),
+    ("api.agregar_persona", "POST", "/people/", person("Budget new person"), 200),
+    ("api.editar_persona", "PUT", "/people/{person}", person("Budget person"), 200),
+    ("api.agregar_vehiculo", "POST", "/vehicle", vehicle("Budget new vehicle"), 201),
+    ("api.editar_vehiculo", "PUT", "/vehicles/{vehicle}", vehicle("Budget vehicle"), 200),
+    ("api.agregar_planetas_en_lote", "POST", "/planet/bulk", [planet("Budget bulk planet %d" % i) for i in range(3)], 201),
+    ("api.agregar_personas_en_lote", "POST", "/people/bulk", [person("Budget bulk person %d" % i) for i in range(3)], 201),
+    ("api.agregar_vehiculos_en_lote", "POST", "/vehicle/bulk", [vehicle("Budget bulk vehicle %d" % i) for i in range(3)], 201),
+    ("api.agregar_fav_planeta", "POST", "/favorite/planet/{planet}", {"user_id": "{user}"}, 200),
+    ("api.agregar_fav_people", "POST", "/favorite/people/{person}", {"user_id": "{user}"}, 200),
+    ("api.sincronizar_favoritos", "POST", "/favorite/batch", {"user_id": "{user}", "add": {"vehicles": ["{vehicle}"]}}, 200),
+    ("api.eliminar_fav_planeta", "DELETE", "/favorite/planet/{planet}", {"user_id": "{user}"}, 200),
+    ("api.eliminar_fav_people", "DELETE", "/favorite/people/{person}", {"user_id": "{user}"}, 200),
+    ("api.eliminar_planeta", "DELETE", "/planet/{planet}", None, 200),
+    ("api.eliminar_persona", "DELETE", "/people/{person}", None, 200),
+    ("api.eliminar_vehiculo", "DELETE", "/vehicles/{vehicle}", None, 200),
+)
+
+def fill(value, ids):
+    # "{planet}" -> the id of the seeded planet, also inside the JSON bodies
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}"):
+        return ids[value[1:-1]]
+    if isinstance(value, str):
+        return value.format(**ids)
+    if isinstance(value, list):
+        return [fill(item, ids) for item in value]
+    if isinstance(value, dict):
+        return {key: fill(item, ids) for key, item in value.items()}
+    return value
+
+def run_routes(app):
+    # endpoint -> (status or the exception raised, statements run)
+    with app.app_context():
+        engine = db.engine
+    ids = app.config["SEEDED_IDS"]
+    client = app.test_client()
+    statements = []
+    listener = lambda *args: statements.append(1)
+    event.listen(engine, "before_cursor_execute", listener)
+    results = {}
+    try:
+        for endpoint, method, url, body, _ in ROUTES:
+            del statements[:]
+            try:
+                outcome = client.open(fill(url, ids), method=method, json=fill(body, ids)).status_code
+            except QueryBudgetExceeded as error:
+                outcome = error
+            results[endpoint] = (outcome, len(statements))
+    finally:
+        event.remove(engine, "before_cursor_execute", listener)
+    return results
+
+@pytest.fixture(scope="module")
+def route_results(seeded_apps):
+    return {size: run_routes(app) for size, app in seeded_apps.items()}
+
+def test_every_api_route_is_exercised(app):
+    endpoints = {rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint.startswith("api.")}
+    assert endpoints == {route[0] for route in ROUTES}
+
+@pytest.mark.parametrize("endpoint, status", [(route[0], route[4]) for route in ROUTES])
+def test_route_stays_within_its_budget(route_results, endpoint, status):
+    for size, results in route_results.items():
+        outcome, _ = results[endpoint]
+        assert not isinstance(outcome, QueryBudgetExceeded), "%s (%s data): %s" % (endpoint, size, outcome)
+        assert outcome == status, "%s (%s data)" % (endpoint, size)
+
+@pytest.mark.parametrize("endpoint", [route[0] for route in ROUTES])
+def test_statements_do_not_grow_with_the_data(route_results, endpoint):
+    counts = {size: results[endpoint][1] for size, results in route_results.items()}
+    assert len(set(counts.values())) == 1, "%s: %s" % (endpoint, counts)
@@ -0,0 +1,54 @@
+import sqlite3
+import pytest
+from seed import create_bench_app, seed
+from models import db
+
+def create_replicated_app(primary, replica_url):
+    app = create_bench_app("sqlite:///%s" % primary, TESTING=True, CACHE_ENABLED=False, SQLALCHEMY_REPLICA_URIS=[replica_url])
+    with app.app_context():
+        seed(db, people=5, planets=5, vehicles=5, users=2, favorites=0)
+        db.session.remove()
+    return app
+
+def planet_names(path):
+    with sqlite3.connect(str(path)) as connection:
+        return {name for (name,) in connection.execute("SELECT name FROM planets")}
+
+@pytest.fixture
+def replicated(tmp_path):
+    primary, replica = tmp_path / "primary.db", tmp_path / "replica.db"
+    app = create_replicated_app(primary, "sqlite:///%s" % replica)
+    # the replica is a copy of the primary with one planet renamed, to tell them apart
+    with sqlite3.connect(str(primary)) as source, sqlite3.connect(str(replica)) as target:
+        source.backup(target)
+        target.execute("UPDATE planets SET name = 'Replica planet' WHERE id = 1")
+    yield app, primary, replica
+    with app.app_context():
+        for engine in [db.engine] + app.extensions["replicas"].engines:
+            engine.dispose()
+
+def test_reads_go_to_the_replica_and_writes_to_the_primary(replicated):
+    app, primary, replica = replicated
+    client = app.test_client()
+
+    assert client.get("/planets/1").get_json()["name"] == "Replica planet"
+
+    body = {"name": "Written planet", "gravity": "1", "population": "1000", "terrain": "desert"}
+    assert client.post("/planet", json=body).status_code == 200
+    assert "Written planet" in planet_names(primary)
+    assert "Written planet" not in planet_names(replica)
+
+def test_reads_fall_back_to_the_primary_without_a_replica(tmp_path):
+    # the directory of the replica does not exist, SQLite cannot open it
+    app = create_replicated_app(tmp_path / "primary.db", "sqlite:///%s" % (tmp_path / "missing" / "replica.db"))
+    client = app.test_client()
+    try:
+        response = client.get("/planets/1")
+        assert response.status_code == 200
+        assert response.get_json()["name"] == "Planet 0"
+
+        replica = client.get("/pool/stats").get_json()["replicas"][0]
+        assert (replica["healthy"], replica["failures"]) == (False, 1)
+    finally:
+        with app.app_context():
+            db.engine.dispose()